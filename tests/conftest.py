@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The simulator is a single script at the top of the repo, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
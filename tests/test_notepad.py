@@ -0,0 +1,49 @@
+import os
+import re
+
+import pytest
+
+import windows10_sim_Version10 as sim
+
+def test_interrupted_write_leaves_previous_file(tmp_path):
+    path = str(tmp_path / "notes.txt")
+    with open(path, "wb") as f:
+        f.write(b"previous contents\n")
+    def chunks():
+        yield b"new line\n" * 1000
+        raise OSError("disk full")
+    with pytest.raises(OSError, match="disk full"):
+        sim.write_atomic(path, chunks())
+    with open(path, "rb") as f:
+        assert f.read() == b"previous contents\n"
+    assert os.listdir(tmp_path) == ["notes.txt"]
+
+def test_edited_piece_table_streams_out_whole(tmp_path):
+    source, target = str(tmp_path / "in.txt"), str(tmp_path / "out.txt")
+    text = b"".join(b"line %d\n" % i for i in range(20000))
+    with open(source, "wb") as f:
+        f.write(text)
+    doc = sim.PieceTable.open(source)
+    doc.replace(7, 7, b"inserted ")
+    doc.replace(len(doc) - 11, len(doc), b"")
+    expected = text[:7] + b"inserted " + text[7:-11]
+    sim.write_atomic(target, doc.snapshot().chunks(size=4096))
+    doc.close()
+    with open(target, "rb") as f:
+        assert f.read() == expected
+
+@pytest.mark.parametrize("pattern", [rb"a*", rb"^", rb"$", rb"\A", rb"\Z", rb"\bb", rb"^a*$"])
+def test_empty_matches_agree_with_a_full_scan(pattern):
+    regex = re.compile(pattern, re.MULTILINE)
+    doc = sim.PieceTable(b"ab\n\naab\nb\naa")
+    index = sim.MatchIndex(doc, regex, chunk=3)
+    index.step()
+    for start, end, data in [(4, 4, b"a\n"), (0, 1, b""), (len(doc) - 1, len(doc) - 1, b"b\n\n")]:
+        doc.replace(start, end, data)
+        index.edited(start, end, start + len(data))
+    while not index.done:
+        index.step()
+    text = doc.read(0, len(doc))
+    assert list(zip(index.starts, index.ends)) == [m.span() for m in regex.finditer(text)]
+    assert doc.sub(regex, b"<\\g<0>>", size=3) == len(regex.findall(text))
+    assert doc.read(0, len(doc)) == regex.sub(b"<\\g<0>>", text)
@@ -0,0 +1,195 @@
+import os
+import subprocess
+import sys
+import textwrap
+import tkinter as tk
+
+import pytest
+from PIL import Image, ImageDraw
+
+import windows10_sim_Version10 as sim
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def scribble(core, points):
+    core.begin_stroke(*points[0])
+    for point in points[1:]:
+        core.extend_stroke(*point)
+    core.end_stroke()
+
+def test_save_strokes_header_keeps_document_size(tmp_path):
+    # Ops are encoded with their own pen width (0 for a fill); none of them may end up as
+    # the document width in the header
+    path = str(tmp_path / "doc.w1p")
+    ops = [{"color": "#ff0000", "width": 5, "points": [1, 2, 30, 40]}, {"fill": [5, 5], "color": "#00ff00"}]
+    sim.save_strokes(path, ops, 320, 200)
+    with sim.StrokeDocument(path) as doc:
+        assert (doc.width, doc.height) == (320, 200)
+        assert [op.get("fill") for op in doc] == [None, [5, 5]]
+
+def test_stroke_document_opens_at_its_own_size(tmp_path):
+    # A stroke near the corner of a page larger than the default one must survive a reopen
+    path = str(tmp_path / "big.w1p")
+    sim.save_strokes(path, [{"color": "#ff0000", "width": 4, "points": [440, 250, 480, 280]}], 500, 300)
+    core = sim.PaintCore()
+    with sim.StrokeDocument(path) as doc:
+        core.new_document(doc.width, doc.height)
+        core.render(list(doc))
+    assert (core.width, core.height) == (500, 300)
+    assert core.flattened().getpixel((460, 265))[:3] == (255, 0, 0)
+
+def test_replay_keeps_the_current_brush():
+    # Opening or recovering a document must not leave its last op's brush in the toolbar's place
+    core = sim.PaintCore()
+    core.set_color("#00ff00")
+    core.render([{"color": "#ff0000", "width": 9, "brush": "soft", "points": [10, 10, 60, 40]},
+                 {"shape": "rect", "box": [5, 5, 50, 50], "color": "#0000ff", "width": 4}])
+    assert (core.color, core.pen_width, core.brush) == ("#00ff00", 2, "hard")
+
+def test_deferred_flush_saves_the_same_png_as_drawing_each_segment(tmp_path):
+    # Segments queue up and reach the image in one flush; the saved PNG must match one drawn
+    # a segment at a time the way the motion handler used to
+    points = [(10 + 7 * i, 20 + (i * i) % 90) for i in range(40)]
+    core = sim.PaintCore(engine="pil")
+    core.set_color("#1e90ff")
+    core.set_width(5)
+    core.begin_stroke(*points[0])
+    for point in points[1:]:
+        core.extend_stroke(*point)
+        if len(core.pending) == 8:
+            core.flush()
+    core.end_stroke()
+    path = str(tmp_path / "stroke.png")
+    sim.save_image(core.flattened(), path)
+    expected = Image.new("RGB", (core.width, core.height), "white")
+    draw = ImageDraw.Draw(expected)
+    for a, b in zip(points, points[1:]):
+        draw.line([*a, *b], fill="#1e90ff", width=5)
+    with Image.open(path) as saved:
+        assert saved.convert("RGB").tobytes() == expected.tobytes()
+
+@pytest.mark.parametrize("engine", sorted(sim.SURFACES))
+def test_undo_after_soft_stroke_and_fill_is_pixel_identical(engine):
+    # Drawing flushes a frame at a time, undo replays the strokes whole: a stroke's rounding
+    # must not depend on that, or the fill after it floods a different region
+    core = sim.PaintCore(engine=engine)
+    core.set_brush("soft")
+    for y in (40, 50, 60):
+        core.set_width(18)
+        core.begin_stroke(20, y)
+        for x in range(30, 300, 7):
+            core.extend_stroke(x, y + x % 13)
+            if x % 3 == 0:
+                core.flush()
+        core.end_stroke()
+    core.fill(150, 52, "#ff0000")
+    drawn = core.flattened().tobytes()
+    scribble(core, [(10, 150), (200, 120)])
+    core.undo()
+    assert core.flattened().tobytes() == drawn
+    assert sim.PaintCore(engine=engine).render(list(core.history)).tobytes() == drawn
+
+@pytest.mark.parametrize("engine", sorted(sim.SURFACES))
+def test_opened_image_built_off_thread_undoes_to_itself(engine):
+    image = Image.effect_noise((300, 200), 60).convert("RGB")
+    core = sim.PaintCore(engine=engine)
+    surfaces = core.image_surfaces(image)
+    core.load_image(image, None, surfaces)
+    assert core.layers[0].surface is surfaces[0]
+    scribble(core, [(10, 10), (150, 90), (290, 20)])
+    core.undo()
+    assert core.flattened().tobytes() == image.tobytes()
+
+@pytest.fixture
+def root():
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        pytest.skip("no display")
+    root.withdraw()
+    yield root
+    root.destroy()
+
+@pytest.mark.parametrize("engine", sorted(sim.SURFACES))
+def test_width_change_mid_stroke_applies_to_the_rest_of_it(root, engine):
+    # The motion handler reads no Tcl variables: the new width reaches it through the trace
+    app = sim.PaintApp(root, engine=engine)
+    app.journal_dir = None
+    app.update()
+    canvas = app.canvas
+    canvas.event_generate("<ButtonPress-1>", x=20, y=50)
+    app.update()
+    for x in range(30, 101, 10):
+        canvas.event_generate("<B1-Motion>", x=x, y=50)
+        app.update()
+    app.width_var.set(10)
+    for x in range(110, 181, 10):
+        canvas.event_generate("<B1-Motion>", x=x, y=50)
+        app.update()
+    canvas.event_generate("<ButtonRelease-1>", x=180, y=50)
+    app.update()
+    assert [(op["width"], op["points"][:2]) for op in app.core.history] == [(2, [20, 50]), (10, [100, 50])]
+    image = app.core.flattened()
+    assert image.getpixel((60, 54))[:3] == (255, 255, 255)
+    assert image.getpixel((140, 54))[:3] == (0, 0, 0)
+    app.destroy()
+
+def test_shape_drag_adds_no_canvas_items(root):
+    app = sim.PaintApp(root)
+    app.journal_dir = None
+    app.update()
+    app.tool_var.set("rect")
+    canvas = app.canvas
+    canvas.event_generate("<ButtonPress-1>", x=20, y=20)
+    app.update()
+    items = len(canvas.find_all())
+    for i in range(1, 50):
+        canvas.event_generate("<B1-Motion>", x=20 + 5 * i, y=20 + 2 * i)
+        app.update()
+        assert len(canvas.find_all()) == items
+    canvas.event_generate("<ButtonRelease-1>", x=265, y=118)
+    app.update()
+    assert len(canvas.find_all()) == items
+    assert app.core.history[-1]["shape"] == "rect"
+    app.destroy()
+
+def test_killed_mid_stroke_recovers_from_journal(tmp_path):
+    # A child process journals one finished stroke and part of a second, then is killed
+    # without closing the journal
+    path = str(tmp_path / "paint-1-1.w1j")
+    child = subprocess.Popen([sys.executable, "-c", textwrap.dedent(f"""
+        import sys, time
+        sys.path.insert(0, {ROOT!r})
+        import windows10_sim_Version10 as sim
+        core = sim.PaintCore()
+        core.journal = sim.PaintJournal({path!r}, fsync_interval=0.05)
+        core.journal.reset(core.width, core.height)
+        core.set_color("#ff0000")
+        core.begin_stroke(10, 10)
+        core.extend_stroke(80, 40)
+        core.end_stroke()
+        core.set_color("#0000ff")
+        core.begin_stroke(20, 120)
+        core.extend_stroke(150, 130)
+        core.extend_stroke(300, 100)
+        core.journal.progress(core)
+        time.sleep(0.5)
+        print("drawing", flush=True)
+        time.sleep(60)
+    """)], stdout=subprocess.PIPE, text=True)
+    try:
+        assert child.stdout.readline().strip() == "drawing"
+    finally:
+        child.kill()
+        child.wait()
+        child.stdout.close()
+    width, height, base_path, ops = sim.read_journal(path)
+    assert (width, height, base_path) == (340, 170, None)
+    assert [list(op["points"]) for op in ops] == [[10, 10, 80, 40], [20, 120, 150, 130, 300, 100]]
+    recovered, expected = sim.PaintCore(width, height), sim.PaintCore(width, height)
+    recovered.render(ops)
+    expected.set_color("#ff0000")
+    scribble(expected, [(10, 10), (80, 40)])
+    expected.set_color("#0000ff")
+    scribble(expected, [(20, 120), (150, 130), (300, 100)])
+    assert recovered.flattened().tobytes() == expected.flattened().tobytes()
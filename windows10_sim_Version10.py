@@ -1,9 +1,39 @@
+import argparse
+import bisect
+import codecs
+import ctypes
+import glob
+import io
+import json
+import math
+import mmap
+import os
+import queue
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
 import tkinter as tk
 from tkinter import filedialog, messagebox
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
+from itertools import accumulate, chain
+from operator import itemgetter
 try:
-    from PIL import Image, ImageDraw
+    from PIL import Image, ImageColor, ImageDraw
 except ImportError:
     Image = None  # Will warn the user if PIL is missing
+else:
+    Image.MAX_IMAGE_PIXELS = 32768 * 32768  # Paint opens very large images on purpose
+try:
+    import numpy as np
+except ImportError:
+    np = None  # The "numpy" paint engine is unavailable without it
 
 WIN_BG = "#C0C0C0"
 TITLE_BG = "#000080"
@@ -16,6 +46,27 @@ BUTTON_BG = WIN_BG
 BUTTON_FG = "#000000"
 ENTRY_BG = "#FFFFFF"
 ENTRY_FG = "#000000"
+STROKE_CHUNK = 512  # points per canvas polyline before a new item is started
+FRAME_MS = 16  # motion events arriving within one frame are drawn as one update
+TILE_SIZE = 64  # raster tiles re-blitted to the paint canvas when dirty
+STROKE_EXT = ".w1p"  # native Paint stroke documents, see save_strokes()
+CHECKPOINT_INTERVAL = 50  # history ops between raster checkpoints; bounds undo replay
+HISTORY_BUDGET = 64 * 1024 * 1024  # bytes of checkpoints kept for undo
+VIEW_WIDTH, VIEW_HEIGHT = 340, 170  # visible part of the paint document
+MIN_ZOOM, MAX_ZOOM = 1 / 64, 16  # paint zoom steps are powers of two in this range
+LOD_CACHE_TILES = 4096  # reduced tiles kept for zoomed-out views, least recently used dropped
+BRUSHES = ("hard", "soft", "aa")  # hard lines, or soft / anti-aliased dabs (dabs need NumPy)
+BRUSH_SPACING = 0.25  # distance between dabs as a fraction of the pen width
+BRUSH_FLOW = {"soft": 0.35, "aa": 1.0}  # coverage each dab adds at its centre
+DAB_LOG_SCALE = 1 << 24  # dab logs are summed in fixed-point steps of this, exact in any order
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".win1sim", "paint-journal")  # crash recovery journals
+JOURNAL_FSYNC_INTERVAL = 1.0  # seconds of drawing a crash can lose at most
+NOTEPAD_WINDOW_LINES = 400  # lines of a document held in Notepad's Text widget at once
+NOTEPAD_WINDOW_BYTES = 256 * 1024  # ...or fewer, for files with very long lines
+EDIT_BUDGET = 4 * 1024 * 1024  # bytes of Notepad undo journal kept
+EDIT_GROUP_GAP = 1.0  # seconds between keystrokes that still belong to one undo group
+LOAD_CHUNK = 1 << 20  # bytes Notepad scans per step while settling an opened file's encoding
+ENCODING_NAMES = {"utf-8": "UTF-8", "latin-1": "ANSI"}
 
 def win1_button(master, **kwargs):
     opts = {
@@ -31,6 +82,503 @@ def win1_button(master, **kwargs):
     opts.update(kwargs)
     return tk.Button(master, **opts)
 
+def ppm_data(image):
+    # Binary PPM is the cheapest format Tk's PhotoImage.put can decode
+    return f"P6 {image.width} {image.height} 255\n".encode() + image.tobytes()
+
+@lru_cache(maxsize=64)
+def color_rgb(color):
+    if Image is None:
+        return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+    return ImageColor.getrgb(color)[:3]
+
+class PilSurface:
+    # Backing store drawn with ImageDraw; the default paint engine. Layers above the
+    # background are RGBA and start out transparent.
+    def __init__(self, width, height, image=None, transparent=False):
+        self.transparent = transparent
+        self.blank = (255, 255, 255, 0) if transparent else "white"
+        self.image = image or Image.new("RGBA" if transparent else "RGB", (width, height), self.blank)
+        self.draw = ImageDraw.Draw(self.image)
+        self.wet = None  # WetStroke of the dab stroke being drawn
+    @classmethod
+    def from_image(cls, image):
+        return cls(*image.size, image=image.convert("RGB"))
+    def copy(self):
+        return PilSurface(*self.image.size, image=self.image.copy(), transparent=self.transparent)
+    def line(self, x0, y0, x1, y1, color, width):
+        self.draw.line([x0, y0, x1, y1], fill=color, width=width)
+    def lines(self, segments, color, width):
+        line = self.draw.line
+        for segment in segments:
+            line(segment, fill=color, width=width)
+    def paste_at(self, image, x, y):
+        # Images with alpha are composited over what is there, others replace it
+        if image.mode == "RGBA" and self.transparent:
+            self.image.alpha_composite(image, (x, y))
+        elif image.mode == "RGBA":
+            self.image.paste(image, (x, y), image)
+        else:
+            self.image.paste(image.convert(self.image.mode), (x, y))
+    def dabs(self, xs, ys, radii, color, brush):
+        w, h = self.image.size
+        hit = dab_transmittance(xs, ys, radii, brush, w, h)
+        if not hit:
+            return
+        if self.wet is None:
+            self.wet = WetStroke(w, h, len(self.image.getbands()))
+        covered, transmittance = self.wet.soak(hit, lambda box: np.array(self.image.crop(box)))
+        blend_dabs(covered, transmittance, color_rgb(color), self.transparent)
+        # Only the tiles the dabs reach are copied out of the image and back
+        py, px = hit[:2]
+        across = -(-w // TILE_SIZE)
+        tiles = py // TILE_SIZE * across + px // TILE_SIZE
+        order = np.argsort(tiles, kind="stable")
+        tiles, py, px, covered = tiles[order], py[order], px[order], covered[order]
+        cuts = np.flatnonzero(np.diff(tiles)) + 1
+        for lo, hi in zip([0, *cuts], [*cuts, len(tiles)]):
+            ty, tx = divmod(int(tiles[lo]), across)
+            box = (tx * TILE_SIZE, ty * TILE_SIZE, min((tx + 1) * TILE_SIZE, w), min((ty + 1) * TILE_SIZE, h))
+            region = np.array(self.image.crop(box))
+            region[py[lo:hi] - box[1], px[lo:hi] - box[0]] = covered[lo:hi]
+            self.image.paste(Image.fromarray(region), box)
+    def dry(self):
+        self.wet = None
+    def reset(self, box=None):
+        self.image.paste(self.blank, box or (0, 0) + self.image.size)
+    def ppm(self, box):
+        return ppm_data(self.image.crop(box))
+    def crop(self, box):
+        return self.image.crop(box)
+    def shape(self, kind, box, color, width):
+        if kind == "line":
+            self.draw.line(box, fill=color, width=width)
+        elif kind == "rect":
+            self.draw.rectangle(box, outline=color, width=width)
+        else:
+            self.draw.ellipse(box, outline=color, width=width)
+    def flood_fill(self, x, y, color):
+        w, h = self.image.size
+        target = color_rgb(color) + (255,) if self.transparent else color_rgb(color)
+        if not (0 <= x < w and 0 <= y < h) or self.image.getpixel((x, y)) == target:
+            return None
+        if np is None:
+            return scanline_fill_pixels(self.image, x, y, target)
+        raw = "RGBA" if self.transparent else "RGBX"
+        packed = np.frombuffer(self.image.tobytes("raw", raw), dtype=np.uint32).reshape(h, w)
+        spans, box = scanline_fill(packed, x, y)
+        if len(spans) <= 4096:
+            for y, left, right in spans:
+                self.image.paste(color, (left, y, right, y + 1))
+            return box
+        # Many short spans: one masked paste over the bounding box is cheaper
+        mask = np.zeros((box[3] - box[1], box[2] - box[0]), dtype=np.uint8)
+        for y, left, right in spans:
+            mask[y - box[1], left - box[0]:right - box[0]] = 255
+        self.image.paste(color, box, Image.fromarray(mask, "L"))
+        return box
+    def snapshot(self, box):
+        return self.image.crop(box).tobytes()
+    def restore(self, data, box):
+        self.image.paste(Image.frombytes(self.image.mode, (box[2] - box[0], box[3] - box[1]), data), box[:2])
+
+class NumpySurface:
+    # Backing store kept as an HxWx4 uint8 RGBA array so that self.image can be a zero-copy
+    # Image.frombuffer view of it; alpha is opaque except on transparent layers
+    def __init__(self, width, height, transparent=False, pixels=None):
+        if np is None:
+            raise RuntimeError("The numpy paint engine requires NumPy.\nInstall with: pip install numpy")
+        self.transparent = transparent
+        self.blank = (255, 255, 255, 0 if transparent else 255)
+        self.pixels = pixels
+        if pixels is None:
+            self.pixels = np.empty((height, width, 4), dtype=np.uint8)
+            self.pixels[...] = self.blank
+        self.wet = None  # WetStroke of the dab stroke being drawn
+        self.image = Image.frombuffer("RGBA", (width, height), self.pixels, "raw", "RGBA", 0, 1)
+    @classmethod
+    def from_image(cls, image):
+        # Pillow fills the alpha in the same pass that widens the pixels, rather than a blank
+        # fill followed by a strided copy of the colour channels
+        return cls(*image.size, pixels=np.array(image.convert("RGBA")))
+    def copy(self):
+        h, w = self.pixels.shape[:2]
+        return NumpySurface(w, h, self.transparent, self.pixels.copy())
+    def line(self, x0, y0, x1, y1, color, width):
+        self.lines([(x0, y0, x1, y1)], color, width)
+    def lines(self, segments, color, width):
+        # Fill each segment's round-capped footprint as one span per row it crosses, so
+        # pixels are written once per segment covering them however wide the pen
+        h, w = self.pixels.shape[:2]
+        rows, lefts, rights = line_spans(segments, max(width / 2, 0.5), w, h)
+        if not len(rows):
+            return
+        # A pixel, alpha included, is one uint32
+        packed = self.pixels.view(np.uint32)[..., 0]
+        value = np.array(color_rgb(color) + (255,), dtype=np.uint8).view(np.uint32)[0]
+        counts = rights - lefts
+        top, bottom, x0, x1 = rows.min(), rows.max() + 1, lefts.min(), rights.max()
+        bw = x1 - x0 + 1
+        if counts.sum() > (bottom - top) * bw:
+            # Spans mostly overlapping, as a wide pen's short segments do: count where each
+            # starts and ends over the bounding box, and a running sum finds the covered pixels
+            at = (rows - top) * bw - x0
+            edges = np.bincount(at + lefts, minlength=(bottom - top) * bw) - np.bincount(at + rights, minlength=(bottom - top) * bw)
+            packed[top:bottom, x0:x1][np.cumsum(edges).reshape(bottom - top, bw)[:, :-1] > 0] = value
+            return
+        first = np.repeat(rows * w + lefts - (np.cumsum(counts) - counts), counts)
+        packed.reshape(-1)[first + np.arange(len(first))] = value
+    def paste_at(self, image, x, y):
+        region = self.pixels[y:y + image.height, x:x + image.width]
+        if image.mode != "RGBA":
+            region[..., :3] = np.asarray(image.convert("RGB"))
+            region[..., 3] = 255
+            return
+        src = np.asarray(image, dtype=np.float64) / 255
+        alpha, dst_alpha = src[..., 3:4], region[..., 3:4] / 255
+        out = alpha + dst_alpha * (1 - alpha)
+        rgb = (src[..., :3] * alpha + region[..., :3] / 255 * dst_alpha * (1 - alpha)) / np.maximum(out, 1e-6)
+        region[..., :3] = np.rint(rgb * 255)
+        region[..., 3:4] = np.rint(out * 255)
+    def dabs(self, xs, ys, radii, color, brush):
+        h, w = self.pixels.shape[:2]
+        hit = dab_transmittance(xs, ys, radii, brush, w, h)
+        if not hit:
+            return
+        if self.wet is None:
+            self.wet = WetStroke(w, h, 4)
+        covered, transmittance = self.wet.soak(hit, lambda box: self.pixels[box[1]:box[3], box[0]:box[2]])
+        blend_dabs(covered, transmittance, color_rgb(color), self.transparent)
+        self.pixels[hit[0], hit[1]] = covered
+    def dry(self):
+        self.wet = None
+    def reset(self, box=None):
+        if box is None:
+            self.pixels[...] = self.blank
+        else:
+            self.pixels[box[1]:box[3], box[0]:box[2]] = self.blank
+    def ppm(self, box):
+        tile = self.pixels[box[1]:box[3], box[0]:box[2], :3]
+        return f"P6 {tile.shape[1]} {tile.shape[0]} 255\n".encode() + tile.tobytes()
+    def shape(self, kind, box, color, width):
+        self.lines(shape_segments(kind, box), color, width)
+    def flood_fill(self, x, y, color):
+        h, w = self.pixels.shape[:2]
+        if not (0 <= x < w and 0 <= y < h) or tuple(self.pixels[y, x]) == color_rgb(color) + (255,):
+            return None
+        # A pixel, alpha included, is one comparable uint32
+        packed = self.pixels.view(np.uint32)[..., 0]
+        value = np.array(color_rgb(color) + (255,), dtype=np.uint8).view(np.uint32)[0]
+        spans, box = scanline_fill(packed, x, y)
+        for y, left, right in spans:
+            packed[y, left:right] = value
+        return box
+    def crop(self, box):
+        if self.transparent:
+            return Image.fromarray(self.pixels[box[1]:box[3], box[0]:box[2]].copy())
+        return Image.fromarray(self.pixels[box[1]:box[3], box[0]:box[2], :3])
+    def snapshot(self, box):
+        return self.pixels[box[1]:box[3], box[0]:box[2]].tobytes()
+    def restore(self, data, box):
+        region = self.pixels[box[1]:box[3], box[0]:box[2]]
+        region[...] = np.frombuffer(data, dtype=np.uint8).reshape(region.shape)
+
+@lru_cache(maxsize=32)
+def pen_footprint(radius):
+    # Pixel offsets covered by a round pen of the given radius
+    r = int(radius)
+    oy, ox = np.mgrid[-r:r + 1, -r:r + 1]
+    inside = ox * ox + oy * oy <= radius * radius
+    return ox[inside], oy[inside]
+
+def line_spans(segments, radius, w, h):
+    # Rows and [left, right) pixel columns whose centres lie within radius of a segment,
+    # one span per segment and row, clipped to a w x h surface. Across a row the left end
+    # x(t) - sqrt(r^2 - (y - y(t))^2) is convex in t along the segment, so its minimum is
+    # the unconstrained one, where y - y(t) = r * dx * sign(dy) / length, clamped to the
+    # segment; the right end is the mirror image. Both ends are worked out together as
+    # the two rows of 2 x n arrays.
+    seg = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    x0, y0, x1, y1 = seg.T
+    dx, dy = x1 - x0, y1 - y0
+    top = np.maximum(np.ceil(np.minimum(y0, y1) - radius), 0)
+    count = np.maximum(np.minimum(np.floor(np.maximum(y0, y1) + radius), h - 1) - top + 1, 0).astype(np.intp)
+    # Until clamped, t at either end is linear in the row; a horizontal segment has the
+    # same y all along, so its ends are at whichever of its points lies that way
+    slope = 1 / np.where(dy == 0, np.inf, dy)
+    shift = radius * dx * np.sign(dy) / np.maximum(np.hypot(dx, dy), 1e-12)
+    start = np.where(dy == 0, [dx < 0, dx >= 0], (np.array([[-1.0], [1.0]]) * shift - y0) * slope)
+    params = np.stack([x0, y0, dx, dy, slope, start[0], start[1]])
+    params = np.repeat(params, count, axis=1)
+    rows = np.repeat(top - (np.cumsum(count) - count), count) + np.arange(params.shape[1])
+    x0, y0, dx, dy, slope = params[:5]
+    t = np.minimum(np.maximum(params[5:] + slope * rows, 0), 1)
+    across = (rows - y0) - dy * t
+    half = np.sqrt(np.maximum(radius * radius - across * across, 0))
+    ends = x0 + dx * t + np.array([[-1.0], [1.0]]) * half
+    left = np.maximum(np.ceil(ends[0]), 0)
+    right = np.minimum(np.floor(ends[1]) + 1, w)
+    keep = left < right
+    return rows[keep].astype(np.intp), left[keep].astype(np.intp), right[keep].astype(np.intp)
+
+SURFACES = {"pil": PilSurface, "numpy": NumpySurface}
+
+def place_dabs(segments, starts, width):
+    # Dab centres and radii along a batch of segments, starts being each segment's arc length
+    # from its stroke's first point. Dabs sit at fixed multiples of the spacing along the
+    # stroke, so how the segments were split into batches does not move them.
+    seg = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    starts = np.asarray(starts, dtype=np.float64)
+    x0, y0 = seg[:, 0], seg[:, 1]
+    dx, dy = seg[:, 2] - x0, seg[:, 3] - y0
+    length = np.hypot(dx, dy)
+    spacing = max(0.5, width * BRUSH_SPACING)
+    first = np.ceil(starts / spacing)
+    count = np.maximum(np.ceil((starts + length) / spacing) - first, 0).astype(np.intp)
+    which = np.repeat(np.arange(len(seg)), count)
+    s = (first[which] + np.arange(len(which)) - np.repeat(np.cumsum(count) - count, count)) * spacing
+    t = (s - starts[which]) / np.maximum(length[which], 1e-9)
+    # Pressure-style width: the brush swells to full size over its first few widths and
+    # thins on fast strokes, i.e. long segments between motion events
+    ramp = np.minimum(1.0, 0.3 + 0.7 * s / (4 * width))
+    speed = np.clip(1.2 - length[which] / 60, 0.6, 1.0)
+    radii = np.maximum(width / 2 * ramp * speed, 0.5)
+    return x0[which] + dx[which] * t, y0[which] + dy[which] * t, radii
+
+def dab_transmittance(xs, ys, radii, brush, w, h):
+    # How much of the old pixel shows through a batch of same-colour dabs composited one
+    # over another, at each pixel they cover. With a single colour that is the product of
+    # (1 - coverage) over the dabs, so every dab's footprint is summed as logs in one
+    # bincount instead of being blended dab by dab. Returns (ys, xs, log transmittance in
+    # DAB_LOG_SCALE steps) of the covered pixels, or None.
+    if not len(xs):
+        return None
+    r = int(np.ceil(radii.max())) + 1
+    x0, y0 = max(int(np.floor(xs.min())) - r, 0), max(int(np.floor(ys.min())) - r, 0)
+    x1, y1 = min(int(np.ceil(xs.max())) + r + 1, w), min(int(np.ceil(ys.max())) + r + 1, h)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    ox, oy = pen_footprint(r)
+    cx, cy = np.rint(xs), np.rint(ys)
+    px = cx.astype(np.intp)[:, None] + ox
+    py = cy.astype(np.intp)[:, None] + oy
+    # Distances in float32 from each rounded centre: the bulk of the work, kept small
+    fx, fy = (cx - xs).astype(np.float32)[:, None], (cy - ys).astype(np.float32)[:, None]
+    d = np.hypot(ox.astype(np.float32) + fx, oy.astype(np.float32) + fy)
+    radii = radii.astype(np.float32)[:, None]
+    if brush == "soft":
+        coverage = np.clip(1 - (d / radii) ** 2, 0, None) ** 2
+    else:
+        coverage = np.clip(radii + 0.5 - d, 0, 1)
+    coverage *= BRUSH_FLOW.get(brush, 1.0)
+    keep = (coverage > 0) & (px >= x0) & (px < x1) & (py >= y0) & (py < y1)
+    # Whole steps, which float64 adds exactly, so the sums don't depend on the batching
+    logs = np.rint(np.log1p(-np.minimum(coverage[keep], 1 - 1 / 1024)) * DAB_LOG_SCALE)
+    bw, bh = x1 - x0, y1 - y0
+    at = (py[keep] - y0) * bw + (px[keep] - x0)
+    if bw * bh <= 4 * len(at):
+        # Dabs piled up in a small box: sum over all of it and keep the pixels they reached
+        total = np.bincount(at, weights=logs, minlength=bw * bh)
+        at = np.flatnonzero(total)
+        total = total[at]
+    else:
+        # Spread out, like a stroke across the canvas: sum per covered pixel only
+        at, inverse = np.unique(at, return_inverse=True)
+        total = np.bincount(inverse, weights=logs)
+    if not len(at):
+        return None
+    return y0 + at // bw, x0 + at % bw, total
+
+def blend_dabs(region, transmittance, rgb, transparent):
+    # Composite a colour into uint8 RGB or RGBA pixels in place, transmittance having
+    # their shape without the channels
+    t = transmittance[..., None]
+    color = np.array(rgb, dtype=np.float64)
+    if not transparent:
+        region[..., :3] = np.rint(color + (region[..., :3] - color) * t)
+        return
+    alpha = region[..., 3:4] / 255
+    out = 1 - (1 - alpha) * t
+    region[..., :3] = np.rint((color * (1 - t) + region[..., :3] * alpha * t) / np.maximum(out, 1e-6))
+    region[..., 3:4] = np.rint(out * 255)
+
+class WetStroke:
+    # The dab stroke being drawn on a surface. Its dabs are composited from the pixels as they
+    # were before it, with the logs of every batch so far summed per pixel, so a stroke comes
+    # out the same however its segments were batched: per frame while drawing, whole on
+    # replay. Both are kept per TILE_SIZE tile the stroke has reached, in slots of two arrays.
+    def __init__(self, width, height, channels):
+        self.across = -(-width // TILE_SIZE)
+        self.slot_of = np.full(self.across * -(-height // TILE_SIZE), -1, dtype=np.intp)
+        self.count = 0
+        self.before = np.empty((0, TILE_SIZE, TILE_SIZE, channels), dtype=np.uint8)
+        self.sums = np.empty((0, TILE_SIZE, TILE_SIZE))
+    def soak(self, hit, crop):
+        # Add a dab_transmittance batch; returns the pixels it covers as they were before the
+        # stroke and how much of them now shows through. crop(box) reads a tile's pixels.
+        py, px, logs = hit
+        tiles = py // TILE_SIZE * self.across + px // TILE_SIZE
+        slots = self.slot_of[tiles]
+        if slots.min() < 0:
+            new = np.unique(tiles[slots < 0]).tolist()
+            if self.count + len(new) > len(self.sums):
+                grown = max(2 * len(self.sums), self.count + len(new))
+                before = np.empty((grown,) + self.before.shape[1:], dtype=np.uint8)
+                before[:self.count] = self.before[:self.count]
+                sums = np.zeros((grown,) + self.sums.shape[1:])
+                sums[:self.count] = self.sums[:self.count]
+                self.before, self.sums = before, sums
+            for tile in new:
+                ty, tx = divmod(tile, self.across)
+                region = crop((tx * TILE_SIZE, ty * TILE_SIZE, (tx + 1) * TILE_SIZE, (ty + 1) * TILE_SIZE))
+                self.before[self.count, :region.shape[0], :region.shape[1]] = region
+                self.slot_of[tile] = self.count
+                self.count += 1
+            slots = self.slot_of[tiles]
+        # dab_transmittance gives each pixel once, so the sums can be gathered and put back
+        at = (slots * TILE_SIZE + py % TILE_SIZE) * TILE_SIZE + px % TILE_SIZE
+        sums = self.sums.reshape(-1)
+        total = sums[at] + logs
+        sums[at] = total
+        return self.before.reshape(-1, self.before.shape[3])[at], np.exp(total / DAB_LOG_SCALE)
+
+class Layer:
+    # One layer of a Paint document: its own surface, and how it blends into the ones below
+    def __init__(self, surface, visible=True, opacity=255):
+        self.surface = surface
+        self.visible = visible
+        self.opacity = opacity  # 0-255, scales the layer's alpha when composited
+    def rgba(self, box):
+        image = self.surface.crop(box)
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        if self.opacity < 255:
+            image.putalpha(image.getchannel("A").point(opacity_table(self.opacity)))
+        return image
+
+class Checkpoint:
+    # Layer pixels after the first ops history ops. Each layer is (tiles, base, visible,
+    # opacity, transparent) where tiles maps a tile to a [data, compressed] cell; a tile
+    # missing from it still holds the layer's starting pixels, the opened image for the
+    # base layer and blank otherwise. Unchanged tiles share their cell with the checkpoint
+    # before, so a checkpoint costs only what was drawn since it: origin maps each layer to
+    # its index there (None if added since) and delta lists the tiles that were new.
+    def __init__(self, ops, layers, active, origin, delta, cells):
+        self.ops = ops
+        self.layers = layers
+        self.active = active
+        self.origin, self.delta = origin, delta
+        self.cells = cells  # the cells this checkpoint made, which its size counts
+        self.size = sum(len(cell[0]) for cell in cells)
+
+@lru_cache(maxsize=16)
+def opacity_table(opacity):
+    return [a * opacity // 255 for a in range(256)]
+
+def scanline_fill(packed, x, y):
+    # Scanline flood fill over an HxW uint32 array of packed pixels. The match mask is built
+    # with NumPy in one pass; span edges and the runs to seed above/below are then found with
+    # bytes.find, so a span costs a few C-level scans rather than a Python loop per pixel.
+    # Returns the filled spans as (y, left, right) and their bounding box.
+    h, w = packed.shape
+    match = (packed == packed[y, x]).view(np.uint8)
+    spans = []
+    x0, y0, x1, y1 = x, y, x, y
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        row = match[y].tobytes()
+        if row[x] == 0:
+            continue
+        left = row.rfind(b"\0", 0, x) + 1
+        right = row.find(b"\0", x)
+        if right < 0:
+            right = w
+        match[y, left:right] = 0
+        spans.append((y, left, right))
+        x0, x1, y0, y1 = min(x0, left), max(x1, right), min(y0, y), max(y1, y + 1)
+        for ny in (y - 1, y + 1):
+            if 0 <= ny < h:
+                seg = match[ny, left:right].tobytes()
+                i = seg.find(b"\1")
+                while i >= 0:
+                    stack.append((left + i, ny))
+                    i = seg.find(b"\0", i)
+                    if i < 0:
+                        break
+                    i = seg.find(b"\1", i)
+    return spans, (x0, y0, x1, y1)
+
+def scanline_fill_pixels(image, x, y, rgb):
+    # Same scanline fill as scanline_fill, pixel by pixel, for when NumPy is missing
+    w, h = image.size
+    px = image.load()
+    target = px[x, y]
+    x0, y0, x1, y1 = x, y, x, y
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        if px[x, y] != target:
+            continue
+        left, right = x, x + 1
+        while left > 0 and px[left - 1, y] == target:
+            left -= 1
+        while right < w and px[right, y] == target:
+            right += 1
+        for i in range(left, right):
+            px[i, y] = rgb
+        x0, x1, y0, y1 = min(x0, left), max(x1, right), min(y0, y), max(y1, y + 1)
+        for ny in (y - 1, y + 1):
+            if 0 <= ny < h:
+                inside = False
+                for i in range(left, right):
+                    if px[i, ny] == target:
+                        if not inside:
+                            stack.append((i, ny))
+                        inside = True
+                    else:
+                        inside = False
+    return (x0, y0, x1, y1)
+
+def shape_segments(kind, box):
+    # Outline of a shape as line segments, for surfaces that only rasterise lines
+    x0, y0, x1, y1 = box
+    if kind == "line":
+        return [box]
+    if kind == "rect":
+        return [(x0, y0, x1, y0), (x1, y0, x1, y1), (x1, y1, x0, y1), (x0, y1, x0, y0)]
+    cx, cy, rx, ry = (x0 + x1) / 2, (y0 + y1) / 2, (x1 - x0) / 2, (y1 - y0) / 2
+    angles = np.linspace(0, 2 * np.pi, max(8, int(rx + ry) * 2) + 1)
+    xs, ys = cx + rx * np.cos(angles), cy + ry * np.sin(angles)
+    return np.stack([xs[:-1], ys[:-1], xs[1:], ys[1:]], axis=1)
+
+def catmull_rom(p0, p1, p2, p3, steps):
+    # Points of the uniform Catmull-Rom curve from p1 to p2 (p1 excluded, p2 included)
+    points = []
+    for i in range(1, steps + 1):
+        t = i / steps
+        t2, t3 = t * t, t * t * t
+        for a, b, c, d in ((p0[0], p1[0], p2[0], p3[0]), (p0[1], p1[1], p2[1], p3[1])):
+            points.append(round(0.5 * (2 * b + (c - a) * t + (2 * a - 5 * b + 4 * c - d) * t2 + (3 * b - a - 3 * c + d) * t3)))
+    return points
+
+class Clipboard:
+    # In-process clipboard shared by the simulator's apps: text, or an image from Paint.
+    # Tk's clipboard is kept in step, so copied text pastes into text widgets (and other
+    # programs) and copying an image empties it.
+    def __init__(self):
+        self.text, self.image = None, None
+    def set_text(self, text, widget=None):
+        self.text, self.image = text, None
+        if widget is not None:
+            widget.clipboard_clear()
+            widget.clipboard_append(text)
+    def set_image(self, image, widget):
+        self.text, self.image = None, image
+        widget.clipboard_clear()
+
+CLIPBOARD = Clipboard()
+
 class DraggableWindow(tk.Toplevel):
     def __init__(self, master, title="Window", width=300, height=200, **kwargs):
         super().__init__(master, **kwargs)
@@ -60,30 +608,1117 @@ class DraggableWindow(tk.Toplevel):
         y = self.winfo_y() + event.y - self._drag_data["y"]
         self.geometry(f"+{x}+{y}")
 
-class PaintApp(DraggableWindow):
-    def __init__(self, master, **kwargs):
-        super().__init__(master, title="Paint", width=384, height=280, **kwargs)
-        self.current_color = "#000000"
+class PaintCore:
+    # Tk-free drawing state behind PaintApp: brush, stroke in progress, layer stack, undo
+    # history and the dirty-tile bookkeeping a view needs to refresh only what changed
+    def __init__(self, width=340, height=170, engine="pil", history_budget=HISTORY_BUDGET,
+                 checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.width, self.height = width, height
+        self.engine = engine
+        self.color = "#000000"
         self.pen_width = 2
-        self.last_x, self.last_y = None, None
-        self.canvas_width, self.canvas_height = 340, 170
+        self.brush = "hard"
+        self.last = None
+        self.stroke_points = []
+        self.stroke_length = 0.0  # arc length so far, which places dabs and width ramps
+        self.pending = []
+        self.dirty_tiles, self.inked_tiles = set(), set()
+        # Layers bottom to top; drawing goes to the active one, whose surface is self.surface.
+        # below/above cache the flattened layers under and over it for composite().
+        self.layers = [Layer(SURFACES[engine](width, height) if Image else None)]
+        self.active = 0
+        self.surface = self.layers[0].surface
+        self.image = self.surface.image if self.surface else None
+        self.below, self.above = None, None
+        # Undo history: every op ever applied, ops undone since, and tile Checkpoints so undo
+        # replays at most checkpoint_interval ops. origin and changed track each layer against
+        # the last checkpoint the way its origin and delta do against the one before.
+        self.history, self.redo_ops = [], []
+        self.checkpoints = []
+        self.origin, self.changed = [0], [set()]
+        self.base_store = None  # [compressed tiles, uncompressed copy] of an opened image
+        self.history_budget = history_budget
+        self.checkpoint_interval = checkpoint_interval
+        self.base_path = None  # file the base image came from, for the journal
+        self.journal = None  # a PaintJournal that sees every history change
+    def set_color(self, color):
+        if color != self.color:
+            self.split_stroke()
+        self.color = color
+    def set_width(self, width):
+        if width != self.pen_width:
+            self.split_stroke()
+        self.pen_width = width
+    def set_brush(self, brush):
+        if brush != self.brush:
+            self.split_stroke()
+        self.brush = brush
+    def split_stroke(self):
+        # A logged stroke has a single brush, so a mid-stroke brush change starts a new one
+        if self.last is not None:
+            last = self.last
+            self.finish_stroke()
+            self.begin_stroke(*last)
+    def begin_stroke(self, x, y):
+        self.last = (x, y)
+        self.stroke_points = [x, y]
+        self.stroke_length = 0.0
+    def extend_stroke(self, x, y):
+        x0, y0 = self.last
+        self.last = (x, y)
+        self.stroke_points += (x, y)
+        if self.surface:
+            self.pending.append((x0, y0, x, y, self.color, self.pen_width, self.active, self.brush, self.stroke_length))
+        self.stroke_length += math.hypot(x - x0, y - y0)
+    def finish_stroke(self):
+        if len(self.stroke_points) >= 4:
+            op = {"color": self.color, "width": self.pen_width, "points": self.stroke_points, "layer": self.active}
+            if self.brush != "hard":
+                op["brush"] = self.brush
+            self.record(op)
+        self.last = None
+        self.stroke_points = []
+    def end_stroke(self):
+        self.finish_stroke()
+        self.flush()
+        for layer in self.layers:
+            if layer.surface:
+                layer.surface.dry()
+    def draw_stroke(self, stroke):
+        points = stroke["points"]
+        if len(points) and isinstance(points[0], (list, tuple)):
+            points = [c for point in points for c in point]
+        if len(points) < 4:
+            return
+        self.color = stroke.get("color", self.color)
+        self.pen_width = stroke.get("width", self.pen_width)
+        self.brush = stroke.get("brush", "hard")
+        stroke = {"color": self.color, "width": self.pen_width, "points": points, "layer": self.active}
+        if self.brush != "hard":
+            stroke["brush"] = self.brush
+        self.apply(stroke)
+        self.record(stroke)
+    def fill(self, x, y, color=None):
+        self.end_stroke()
+        if color is not None:
+            self.color = color
+        op = {"fill": [x, y], "color": self.color, "layer": self.active}
+        self.apply(op)
+        if op.get("box"):
+            self.record(op)
+            return True
+        return False
+    def shape(self, kind, box, color=None, width=None):
+        self.end_stroke()
+        if color is not None:
+            self.color = color
+        if width is not None:
+            self.pen_width = width
+        x0, y0, x1, y1 = box
+        if kind != "line":
+            x0, x1 = sorted((x0, x1))
+            y0, y1 = sorted((y0, y1))
+        op = {"shape": kind, "box": [x0, y0, x1, y1], "color": self.color, "width": self.pen_width, "layer": self.active}
+        self.apply(op)
+        self.record(op)
+    def render(self, ops):
+        # Replay takes each op's colour, width and brush; the toolbar's own come back after
+        brush = self.color, self.pen_width, self.brush
+        try:
+            for op in ops:
+                if "layers" in op:
+                    self.layer_op(op)
+                    continue
+                self.select_layer(op.get("layer", 0))
+                if "clear" in op:
+                    self.clear()
+                elif "cut" in op:
+                    self.cut(op["cut"])
+                elif "paste" in op:
+                    self.paste(op["image"], *op["paste"])
+                elif "fill" in op:
+                    self.fill(*op["fill"], op.get("color"))
+                elif "shape" in op:
+                    self.shape(op["shape"], op["box"], op.get("color"), op.get("width"))
+                else:
+                    self.draw_stroke(op)
+            self.flush()
+        finally:
+            self.color, self.pen_width, self.brush = brush
+        return self.flattened()
+    def apply(self, op):
+        if "layers" in op:
+            self.apply_layer_op(op)
+            return
+        layer = op.get("layer", 0)
+        if layer != self.active:
+            self.below = self.above = None
+        surface = self.layers[layer].surface
+        if "clear" in op:
+            self.reset_tiles(layer)
+        elif "cut" in op:
+            if surface:
+                self.flush()
+                x0, y0, x1, y1 = op["cut"]
+                surface.reset(op["cut"])
+                self.mark_dirty(x0, y0, x1 - 1, y1 - 1, 0, layer)
+        elif "paste" in op:
+            if surface and op["image"] is not None:
+                self.flush()
+                self.paste_clipped(layer, op["image"], *op["paste"])
+        elif "fill" in op:
+            # A fill reads the pixels, so everything queued before it has to land first
+            if surface:
+                self.flush()
+                op["box"] = box = surface.flood_fill(*op["fill"], op["color"])
+                if box:
+                    self.mark_dirty(box[0], box[1], box[2] - 1, box[3] - 1, 0, layer)
+        elif "shape" in op:
+            if surface:
+                self.flush()
+                surface.shape(op["shape"], op["box"], op["color"], op["width"])
+                self.mark_dirty(*op["box"], op["width"], layer)
+        elif surface:
+            points, color, width, brush = op["points"], op["color"], op["width"], op.get("brush", "hard")
+            xs, ys = points[0::2], points[1::2]
+            length = 0.0
+            for x0, y0, x1, y1 in zip(xs, ys, xs[1:], ys[1:]):
+                self.pending.append((x0, y0, x1, y1, color, width, layer, brush, length))
+                length += math.hypot(x1 - x0, y1 - y0)
+    def paste_clipped(self, layer, image, x, y):
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + image.width, self.width), min(y + image.height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        if (x0, y0, x1, y1) != (x, y, x + image.width, y + image.height):
+            image = image.crop((x0 - x, y0 - y, x1 - x, y1 - y))
+        self.layers[layer].surface.paste_at(image, x0, y0)
+        self.mark_dirty(x0, y0, x1 - 1, y1 - 1, 0, layer)
+    def copy_region(self, box):
+        # Pixels of the active layer; RGBA on layers with transparency
+        self.flush()
+        return self.surface.crop(box)
+    def cut(self, box):
+        self.end_stroke()
+        image = self.copy_region(box)
+        op = {"cut": list(box), "layer": self.active}
+        self.apply(op)
+        self.record(op)
+        return image
+    def paste(self, image, x, y):
+        self.end_stroke()
+        op = {"paste": [x, y], "image": image, "layer": self.active}
+        self.apply(op)
+        self.record(op)
+    def layer_op(self, op):
+        self.end_stroke()
+        self.apply_layer_op(op)
+        self.record(op)
+    def apply_layer_op(self, op):
+        # Layer ops are history entries like strokes: {"layers": action, "index": i} plus
+        # "to" for move and "value" for visible/opacity. Queued segments name their layer by
+        # index, so they land before the stack changes under them.
+        self.flush()
+        action, index = op["layers"], op["index"]
+        if action == "add":
+            surface = SURFACES[self.engine](self.width, self.height, transparent=True) if Image else None
+            self.layers.insert(index, Layer(surface))
+            self.origin.insert(index, None)
+            self.changed.insert(index, set())
+            self.active = index
+        elif action == "remove":
+            del self.layers[index], self.origin[index], self.changed[index]
+            if self.active > index or self.active == len(self.layers):
+                self.active -= 1
+        elif action == "move":
+            to = op["to"]
+            for stack in (self.layers, self.origin, self.changed):
+                stack.insert(to, stack.pop(index))
+            if self.active == index:
+                self.active = to
+            elif index < self.active <= to:
+                self.active -= 1
+            elif to <= self.active < index:
+                self.active += 1
+        elif action == "visible":
+            self.layers[index].visible = op["value"]
+        else:
+            self.layers[index].opacity = op["value"]
+        self.surface = self.layers[self.active].surface
+        self.below = self.above = None
+        self.dirty_tiles |= self.inked_tiles
+    def add_layer(self):
+        self.layer_op({"layers": "add", "index": self.active + 1})
+    def remove_layer(self):
+        if len(self.layers) < 2:
+            return False
+        self.layer_op({"layers": "remove", "index": self.active})
+        return True
+    def move_layer(self, to):
+        if to == self.active or not 0 <= to < len(self.layers):
+            return False
+        self.layer_op({"layers": "move", "index": self.active, "to": to})
+        return True
+    def set_layer_visible(self, visible):
+        self.layer_op({"layers": "visible", "index": self.active, "value": bool(visible)})
+    def set_layer_opacity(self, opacity):
+        self.layer_op({"layers": "opacity", "index": self.active, "value": max(0, min(255, int(opacity)))})
+    def select_layer(self, index):
+        if index == self.active:
+            return
+        self.end_stroke()
+        self.active = index
+        self.surface = self.layers[index].surface
+        self.below = self.above = None
+    def flat(self):
+        layer = self.layers[0]
+        return len(self.layers) == 1 and layer.visible and layer.opacity == 255 and not layer.surface.transparent
+    def composite(self, box):
+        # Flattened RGB pixels of box. Layers below and above the active one come from
+        # cached full-size composites, so a change to the active layer only costs a crop
+        # and two alpha composites of the dirty rectangle.
+        if self.flat():
+            return self.surface.crop(box)
+        if self.below is None:
+            self.cache_composite()
+        image = self.below.crop(box)
+        layer = self.layers[self.active]
+        if layer.visible:
+            image.alpha_composite(layer.rgba(box))
+        if self.above is not None:
+            image.alpha_composite(self.above.crop(box))
+        return image.convert("RGB")
+    def cache_composite(self):
+        full = (0, 0, self.width, self.height)
+        self.below = Image.new("RGBA", (self.width, self.height), "white")
+        for layer in self.layers[:self.active]:
+            if layer.visible:
+                self.below.alpha_composite(layer.rgba(full))
+        self.above = None
+        for layer in self.layers[self.active + 1:]:
+            if layer.visible:
+                if self.above is None:
+                    self.above = Image.new("RGBA", (self.width, self.height), (0, 0, 0, 0))
+                self.above.alpha_composite(layer.rgba(full))
+    def ppm(self, box):
+        if self.flat():
+            return self.surface.ppm(box)
+        return ppm_data(self.composite(box))
+    def flattened(self):
+        return self.composite((0, 0, self.width, self.height)) if self.surface else None
+    def record(self, op):
+        self.history.append(op)
+        self.redo_ops.clear()
+        if self.journal:
+            self.journal.append(op)
+        self.maybe_checkpoint()
+    def image_surfaces(self, image):
+        # The layer an opened image becomes and the copy of it undo restores base tiles from:
+        # full-size conversions, so PaintApp builds them on its decode worker
+        surface = SURFACES[self.engine].from_image(image)
+        return surface, surface.copy()
+    def load_image(self, image, base_path=None, surfaces=None):
+        # Make an opened image the new document: history restarts with it as the base
+        self.end_stroke()
+        self.width, self.height = image.size
+        surface, copy = surfaces or self.image_surfaces(image)
+        self.layers = [Layer(surface)]
+        self.restart(base_path)
+        self.dirty_tiles = set()
+        self.inked_tiles = set(self.all_tiles())
+        # Undo restores base tiles from memory rather than decoding the file again. A worker
+        # compresses them while drawing goes on and drops the copy once it is done.
+        self.base_store = [{}, copy]
+        boxes = {tile: self.tile_box(*tile) for tile in self.inked_tiles}
+        threading.Thread(target=pack_tiles, args=(self.base_store, boxes), daemon=True).start()
+    def new_document(self, width=None, height=None):
+        # A blank single-layer document with no history, resized when given another size
+        self.end_stroke()
+        self.dirty_tiles |= self.inked_tiles
+        if (width or self.width, height or self.height) != (self.width, self.height):
+            self.width, self.height = width or self.width, height or self.height
+            self.layers = [Layer(SURFACES[self.engine](self.width, self.height) if Image else None)]
+            self.dirty_tiles, self.inked_tiles = set(self.all_tiles()), set()
+        else:
+            self.reset_layers()
+        self.restart()
+    def restart(self, base_path=None):
+        self.active = 0
+        self.surface = self.layers[0].surface
+        self.image = self.surface.image if self.surface else None
+        self.below = self.above = None
+        self.pending.clear()
+        self.history.clear()
+        self.redo_ops.clear()
+        self.checkpoints.clear()
+        self.origin, self.changed = [0], [set()]
+        self.base_store = None
+        self.base_path = base_path
+        if self.journal:
+            self.journal.reset(self.width, self.height, base_path)
+    def reset_layers(self):
+        # Back to one blank opaque background layer
+        if self.surface is None:
+            self.layers = [Layer(None)]
+            return
+        background = next((layer.surface for layer in self.layers if not layer.surface.transparent), None)
+        if background is None:
+            background = SURFACES[self.engine](self.width, self.height)
+        background.reset()
+        self.layers = [Layer(background)]
+    def document(self):
+        # The ops that make up what is on the canvas now: everything since the last clear of
+        # a single-layer document (with more layers, earlier ops can still show elsewhere)
+        for i in range(len(self.history) - 1, -1, -1):
+            if self.history[i].get("flat"):
+                return self.history[i + 1:]
+        return list(self.history)
+    def maybe_checkpoint(self):
+        # Saves only the tiles drawn on since the last checkpoint
+        if not self.surface or not self.checkpoint_interval:
+            return
+        last = self.checkpoints[-1] if self.checkpoints else None
+        if len(self.history) - (last.ops if last else 0) < self.checkpoint_interval:
+            return
+        self.flush()
+        before = last.layers if last else self.first_layers()
+        layers, cells = [], []
+        for layer, origin, changed in zip(self.layers, self.origin, self.changed):
+            tiles, base = (dict(before[origin][0]), before[origin][1]) if origin is not None else ({}, False)
+            for tile in changed:
+                tiles[tile] = cell = [layer.surface.snapshot(self.tile_box(*tile)), False]
+                cells.append(cell)
+            layers.append((tiles, base, layer.visible, layer.opacity, layer.surface.transparent))
+        self.checkpoints.append(Checkpoint(len(self.history), layers, self.active, self.origin, self.changed, cells))
+        self.origin, self.changed = list(range(len(self.layers))), [set() for layer in self.layers]
+        # Over budget: compress the oldest tiles first, then drop the oldest checkpoints
+        used = sum(cp.size for cp in self.checkpoints)
+        for cp in self.checkpoints:
+            for cell in cp.cells:
+                if used <= self.history_budget:
+                    break
+                if not cell[1]:
+                    packed = zlib.compress(cell[0], 1)
+                    used -= len(cell[0]) - len(packed)
+                    cp.size -= len(cell[0]) - len(packed)
+                    cell[0], cell[1] = packed, True
+        while used > self.history_budget and self.checkpoints:
+            used -= self.drop_checkpoint()
+    def drop_checkpoint(self):
+        # Forget the oldest checkpoint. Cells the next one still shares move to it, and its
+        # origin and delta (or the live ones, if none is left) are folded back onto the start
+        # of the history. Returns the bytes freed.
+        old = self.checkpoints.pop(0)
+        if not self.checkpoints:
+            self.fold(old, self.origin, self.changed)
+            return old.size
+        new = self.checkpoints[0]
+        mine = {id(cell) for cell in old.cells}
+        kept = [cell for tiles in new.layers for cell in tiles[0].values() if id(cell) in mine]
+        size = sum(len(cell[0]) for cell in kept)
+        new.cells += kept
+        new.size += size
+        self.fold(old, new.origin, new.delta)
+        return old.size - size
+    def fold(self, cp, origin, delta):
+        # Re-base origin and delta, given against checkpoint cp, onto the checkpoint before it
+        for i, j in enumerate(origin):
+            if j is not None:
+                delta[i] |= cp.delta[j]
+                origin[i] = cp.origin[j]
+    def first_layers(self):
+        # The layer stack before any history, as Checkpoint layers
+        return [({}, True, True, 255, False)]
+    def undo(self):
+        self.end_stroke()
+        if not self.history:
+            return False
+        op = self.history.pop()
+        self.redo_ops.append(op)
+        if self.journal:
+            self.journal.undo()
+        while self.checkpoints and self.checkpoints[-1].ops > len(self.history):
+            self.fold(self.checkpoints.pop(), self.origin, self.changed)
+        self.mark_op(op)
+        self.rebuild()
+        return True
+    def redo(self):
+        self.end_stroke()
+        if not self.redo_ops:
+            return False
+        op = self.redo_ops.pop()
+        self.mark_op(op)
+        self.apply(op)
+        self.history.append(op)
+        if self.journal:
+            self.journal.redo()
+        self.maybe_checkpoint()
+        self.flush()
+        return True
+    def rebuild(self):
+        # Roll the layers back to the nearest checkpoint and replay only the ops after it. A
+        # layer still in the stack gets back just the tiles drawn on since; one a layer op has
+        # removed is rebuilt from the checkpoint whole.
+        if not self.surface:
+            return
+        self.pending.clear()
+        active = self.active
+        last = self.checkpoints[-1] if self.checkpoints else None
+        kept = {j: (layer, changed) for layer, j, changed in zip(self.layers, self.origin, self.changed) if j is not None}
+        layers = []
+        for j, (tiles, base, visible, opacity, transparent) in enumerate(last.layers if last else self.first_layers()):
+            if j in kept:
+                layer, changed = kept[j]
+                layer.visible, layer.opacity = visible, opacity
+            else:
+                layer = Layer(SURFACES[self.engine](self.width, self.height, transparent=transparent), visible, opacity)
+                changed = self.all_tiles() if base else tiles
+            for tile in changed:
+                self.restore_tile(layer.surface, tile, tiles, base)
+            layers.append(layer)
+        self.layers = layers
+        self.origin, self.changed = list(range(len(layers))), [set() for layer in layers]
+        # Layer ops move the active index as they replay, so it starts where the stack did
+        self.active = last.active if last else 0
+        self.surface = self.layers[self.active].surface
+        for op in self.history[last.ops if last else 0:]:
+            self.apply(op)
+        self.flush()
+        self.active = min(active, len(self.layers) - 1)
+        self.surface = self.layers[self.active].surface
+        self.below = self.above = None
+    def restore_tile(self, surface, tile, tiles, base):
+        box = self.tile_box(*tile)
+        cell = tiles.get(tile)
+        if cell:
+            surface.restore(zlib.decompress(cell[0]) if cell[1] else cell[0], box)
+        elif base and self.base_store:
+            copy = self.base_store[1]  # read first: it is only dropped once every tile is packed
+            data = self.base_store[0].get(tile)
+            surface.restore(zlib.decompress(data) if data else copy.snapshot(box), box)
+        else:
+            surface.reset(box)
+    def mark_op(self, op):
+        # Tiles an op touched, which are the only ones undoing or redoing it can change
+        if "clear" in op:
+            self.dirty_tiles |= op["tiles"]
+        elif "layers" in op:
+            self.dirty_tiles |= self.inked_tiles
+        elif "cut" in op:
+            x0, y0, x1, y1 = op["cut"]
+            self.mark_dirty(x0, y0, x1 - 1, y1 - 1, 0)
+        elif "paste" in op:
+            x, y = op["paste"]
+            if op["image"] is not None:
+                self.mark_dirty(x, y, x + op["image"].width - 1, y + op["image"].height - 1, 0)
+        elif "fill" in op:
+            box = op.get("box")
+            if box:
+                self.mark_dirty(box[0], box[1], box[2] - 1, box[3] - 1, 0)
+        elif "shape" in op:
+            self.mark_dirty(*op["box"], op["width"])
+        elif len(op["points"]):
+            xs, ys = op["points"][0::2], op["points"][1::2]
+            self.mark_dirty(min(xs), min(ys), max(xs), max(ys), op["width"])
+    def flush(self):
+        if not self.pending:
+            return
+        # Hand the surface each run of same-brush segments in one call
+        run, starts, brush = [], [], None
+        for x0, y0, x1, y1, color, width, layer, kind, start in self.pending:
+            # Dab strokes composite one at a time (see soak), so a run ends where one starts
+            if (color, width, layer, kind) != brush or (not start and kind != "hard"):
+                if run:
+                    self.draw_run(run, starts, *brush)
+                run, starts, brush = [], [], (color, width, layer, kind)
+            run.append((x0, y0, x1, y1))
+            starts.append(start)
+            self.mark_dirty(x0, y0, x1, y1, width, layer)
+        if run:
+            self.draw_run(run, starts, *brush)
+        self.pending.clear()
+    def draw_run(self, segments, starts, color, width, layer, brush):
+        surface = self.layers[layer].surface
+        if brush == "hard" or np is None:
+            surface.lines(segments, color, width)
+        else:
+            if not starts[0]:
+                surface.dry()
+            surface.dabs(*place_dabs(segments, starts, width), color, brush)
+    def clear(self):
+        # Clears the active layer
+        self.end_stroke()
+        op = {"clear": True, "tiles": self.inked_tiles | self.dirty_tiles, "layer": self.active}
+        if len(self.layers) == 1 and self.layers[0].visible and self.layers[0].opacity == 255:
+            op["flat"] = True
+        self.reset_tiles(self.active)
+        self.record(op)
+    def reset_tiles(self, layer):
+        # Only tiles that were ever drawn on need resetting; they stay dirty so views repaint them.
+        # Queued segments may belong to other layers, so they land first.
+        self.flush()
+        touched = self.inked_tiles | self.dirty_tiles
+        surface = self.layers[layer].surface
+        if surface:
+            for tile in touched:
+                surface.reset(self.tile_box(*tile))
+        self.changed[layer] |= touched
+        self.inked_tiles.clear()
+        self.dirty_tiles = touched
+    def tile_box(self, tx, ty):
+        x0, y0 = tx * TILE_SIZE, ty * TILE_SIZE
+        return (x0, y0, min(x0 + TILE_SIZE, self.width), min(y0 + TILE_SIZE, self.height))
+    def mark_dirty(self, x0, y0, x1, y1, width, layer=None):
+        # layer is given when pixels of that layer changed, which the next checkpoint saves
+        pad = width // 2 + 2
+        tx0 = max(min(x0, x1) - pad, 0) // TILE_SIZE
+        ty0 = max(min(y0, y1) - pad, 0) // TILE_SIZE
+        tx1 = min(max(x0, x1) + pad, self.width - 1) // TILE_SIZE
+        ty1 = min(max(y0, y1) + pad, self.height - 1) // TILE_SIZE
+        tiles = [(tx, ty) for ty in range(ty0, ty1 + 1) for tx in range(tx0, tx1 + 1)]
+        self.dirty_tiles.update(tiles)
+        if layer is not None:
+            self.changed[layer].update(tiles)
+    def all_tiles(self):
+        return [(tx, ty) for ty in range((self.height + TILE_SIZE - 1) // TILE_SIZE)
+                for tx in range((self.width + TILE_SIZE - 1) // TILE_SIZE)]
+    def take_dirty(self):
+        boxes = [self.tile_box(*tile) for tile in self.dirty_tiles]
+        self.inked_tiles |= self.dirty_tiles
+        self.dirty_tiles.clear()
+        return [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+
+def pack_tiles(store, boxes):
+    # Compress a [tiles, surface] store's surface into tiles, then let the surface go
+    tiles, surface = store
+    for tile, box in boxes.items():
+        tiles[tile] = zlib.compress(surface.snapshot(box), 1)
+    store[1] = None
 
-        # --- Toolbar (Save button is always shown)
+class LodCache:
+    # Mip-map pyramid of the document in TILE_SIZE tiles: level n is the document halved n
+    # times, and each tile is built from the four tiles below it, so zoomed-out views never
+    # resample the full image. Tiles are kept LRU and dropped when the pixels under them change.
+    def __init__(self, core, max_tiles=LOD_CACHE_TILES):
+        self.core = core
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+    def level_size(self, level):
+        f = 1 << level
+        return (self.core.width + f - 1) // f, (self.core.height + f - 1) // f
+    def tile(self, level, tx, ty):
+        if level == 0:
+            return self.core.composite(self.core.tile_box(tx, ty))
+        key = (level, tx, ty)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+        w, h = self.level_size(level - 1)
+        children = [(i, j, self.tile(level - 1, 2 * tx + i, 2 * ty + j))
+                    for j in (0, 1) for i in (0, 1)
+                    if (2 * tx + i) * TILE_SIZE < w and (2 * ty + j) * TILE_SIZE < h]
+        right = max(i * TILE_SIZE + child.width for i, j, child in children)
+        bottom = max(j * TILE_SIZE + child.height for i, j, child in children)
+        block = Image.new("RGB", (right, bottom), "white")
+        for i, j, child in children:
+            block.paste(child, (i * TILE_SIZE, j * TILE_SIZE))
+        tile = block.reduce(2)
+        self.tiles[key] = tile
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return tile
+    def invalidate(self, boxes):
+        if not self.tiles:
+            return
+        levels = {key[0] for key in self.tiles}
+        for x0, y0, x1, y1 in boxes:
+            for level in levels:
+                span = TILE_SIZE << level
+                for ty in range(y0 // span, (y1 - 1) // span + 1):
+                    for tx in range(x0 // span, (x1 - 1) // span + 1):
+                        self.tiles.pop((level, tx, ty), None)
+    def clear(self):
+        self.tiles.clear()
+
+def render_strokes(strokes, width=340, height=170, engine="pil"):
+    # Module level so it can be handed to a process pool
+    return PaintCore(width, height, engine, checkpoint_interval=0).render(strokes)
+
+# Native stroke document layout (little-endian):
+#   header  magic, version, reserved, width, height, stroke count, index offset
+#   records one per op: kind, r, g, b, pen width, layer, point count, then int16 x/y pairs
+#           (a stroke's polyline, the seed point of a fill, or a shape's two corners).
+#           Layer ops have no points and reuse the fields: action in r, visible/opacity
+#           value in g, layer index in pen width and the move target in layer. A cut has
+#           its box as points; a paste has its corner, then the pixels as width, height,
+#           band count and length (u32 each) and zlib-compressed raw bytes. A clear has
+#           no points; r is 1 when it cleared a flat single-layer document.
+#   index   one u64 file offset per record, so replay can start at any stroke
+STROKE_MAGIC = b"W1PAINT\0"
+STROKE_HEADER = struct.Struct("<8sHHIIIQ")
+STROKE_RECORD = struct.Struct("<BBBBHHI")
+STROKE_KIND, FILL_KIND, LAYER_KIND = 0, 1, 5
+SHAPE_KINDS = {"line": 2, "rect": 3, "ellipse": 4}
+BRUSH_KINDS = {"soft": 6, "aa": 7}  # strokes drawn with a dab brush
+CUT_KIND, PASTE_KIND, CLEAR_KIND = 8, 9, 10
+PASTE_PIXELS = struct.Struct("<IIII")
+LAYER_ACTIONS = ["add", "remove", "move", "visible", "opacity"]
+STROKE_VERSION = 2  # version 1 had no layers; its records read as layer 0
+
+def encode_op(op):
+    # One op as a native record: the STROKE_RECORD header, its int16 points, then any payload
+    if "layers" in op:
+        return STROKE_RECORD.pack(LAYER_KIND, LAYER_ACTIONS.index(op["layers"]), int(op.get("value", 0)),
+                                  0, op["index"], op.get("to", 0), 0)
+    if "clear" in op:
+        return STROKE_RECORD.pack(CLEAR_KIND, int(bool(op.get("flat"))), 0, 0, 0, op.get("layer", 0), 0)
+    payload = b""
+    if "cut" in op:
+        kind, coords, width = CUT_KIND, op["cut"], 0
+    elif "paste" in op:
+        kind, coords, width = PASTE_KIND, op["paste"], 0
+        image = op["image"]
+        pixels = zlib.compress(image.tobytes(), 1)
+        payload = PASTE_PIXELS.pack(image.width, image.height, len(image.getbands()), len(pixels)) + pixels
+    elif "fill" in op:
+        kind, coords, width = FILL_KIND, op["fill"], 0
+    elif "shape" in op:
+        kind, coords, width = SHAPE_KINDS[op["shape"]], op["box"], op["width"]
+    else:
+        kind = BRUSH_KINDS.get(op.get("brush"), STROKE_KIND)
+        coords, width = op["points"], op["width"]
+    try:
+        points = array("h", coords)
+    except (OverflowError, TypeError):
+        points = array("h", (max(-32768, min(32767, int(c))) for c in coords))
+    if sys.byteorder == "big":
+        points.byteswap()
+    header = STROKE_RECORD.pack(kind, *color_rgb(op.get("color", "#000000")), width, op.get("layer", 0), len(points) // 2)
+    return header + points.tobytes() + payload
+
+def decode_op(buffer, offset):
+    kind, r, g, b, width, layer, count = STROKE_RECORD.unpack_from(buffer, offset)
+    if kind == LAYER_KIND:
+        op = {"layers": LAYER_ACTIONS[r], "index": width}
+        if op["layers"] == "move":
+            op["to"] = layer
+        elif op["layers"] == "visible":
+            op["value"] = bool(g)
+        elif op["layers"] == "opacity":
+            op["value"] = g
+        return op
+    if kind == CLEAR_KIND:
+        return {"clear": True, "layer": layer, "flat": True} if r else {"clear": True, "layer": layer}
+    start = offset + STROKE_RECORD.size
+    points = array("h", buffer[start:start + 4 * count])
+    if sys.byteorder == "big":
+        points.byteswap()
+    if kind == CUT_KIND:
+        return {"cut": list(points), "layer": layer}
+    if kind == PASTE_KIND:
+        w, h, bands, size = PASTE_PIXELS.unpack_from(buffer, start + 4 * count)
+        image = None
+        if Image is not None:
+            offset = start + 4 * count + PASTE_PIXELS.size
+            pixels = zlib.decompress(buffer[offset:offset + size])
+            image = Image.frombytes("RGBA" if bands == 4 else "RGB", (w, h), pixels)
+        return {"paste": list(points), "image": image, "layer": layer}
+    if kind == FILL_KIND:
+        return {"fill": list(points), "color": f"#{r:02x}{g:02x}{b:02x}", "layer": layer}
+    for shape, shape_kind in SHAPE_KINDS.items():
+        if kind == shape_kind:
+            return {"shape": shape, "box": list(points), "color": f"#{r:02x}{g:02x}{b:02x}", "width": width, "layer": layer}
+    stroke = {"color": f"#{r:02x}{g:02x}{b:02x}", "width": width, "points": points, "layer": layer}
+    for brush, brush_kind in BRUSH_KINDS.items():
+        if kind == brush_kind:
+            stroke["brush"] = brush
+    return stroke
+
+def save_strokes(path, strokes, width, height):
+    with open(path, "wb") as f:
+        f.write(bytes(STROKE_HEADER.size))
+        offsets = array("Q")
+        for stroke in strokes:
+            offsets.append(f.tell())
+            f.write(encode_op(stroke))
+        index_offset = f.tell()
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        f.write(offsets.tobytes())
+        f.seek(0)
+        f.write(STROKE_HEADER.pack(STROKE_MAGIC, STROKE_VERSION, 0, width, height, len(offsets), index_offset))
+
+class StrokeDocument:
+    # Read-only, memory-mapped view of a native stroke document; strokes are decoded on access
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.width, self.height, self.count, self.index_offset = STROKE_HEADER.unpack_from(self.map)
+        if magic != STROKE_MAGIC or not 1 <= version <= STROKE_VERSION:
+            self.map.close()
+            raise ValueError(f"{path} is not a Paint stroke document")
+    def __len__(self):
+        return self.count
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        offset, = struct.unpack_from("<Q", self.map, self.index_offset + 8 * i)
+        return decode_op(self.map, offset)
+    def __iter__(self):
+        return self.iter_strokes()
+    def iter_strokes(self, start=0):
+        for i in range(start, self.count):
+            yield self[i]
+    def close(self):
+        self.map.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+# Crash journal layout: JOURNAL_MAGIC, then frames of kind, body length and CRC-32 of the
+# body. Op and partial-stroke bodies are native records (encode_op); a reset body is the
+# document size and the UTF-8 path of its base image, if any. A torn or corrupt frame
+# marks where the writer was when the process died, so reading stops there.
+JOURNAL_MAGIC = b"W1PJRNL\0"
+JOURNAL_FRAME = struct.Struct("<BII")
+JOURNAL_SIZE = struct.Struct("<II")
+J_RESET, J_OP, J_BEGIN, J_PARTIAL, J_UNDO, J_REDO = range(6)  # J_BEGIN is a stroke's first piece
+
+class PaintJournal:
+    # Append-only crash journal of one Paint document. The Tk thread only queues history
+    # changes (and each frame, the new points of the stroke in progress); a daemon thread
+    # encodes and appends them in batches and fsyncs at most every fsync_interval seconds.
+    def __init__(self, path, fsync_interval=JOURNAL_FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.queue = queue.SimpleQueue()
+        self.stroke, self.sent = None, 0
+        self.file = open(path, "wb")
+        self.file.write(JOURNAL_MAGIC)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def reset(self, width, height, base_path=None):
+        self.queue.put((J_RESET, (width, height, base_path)))
+    def append(self, op):
+        self.queue.put((J_OP, op))
+    def undo(self):
+        self.queue.put((J_UNDO, None))
+    def redo(self):
+        self.queue.put((J_REDO, None))
+    def progress(self, core):
+        # Queue the points the stroke in progress gained since the last call
+        points = core.stroke_points
+        if points is not self.stroke:
+            self.stroke, self.sent = points, 0
+        if len(points) > self.sent:
+            piece = {"color": core.color, "width": core.pen_width, "points": points[self.sent:], "layer": core.active}
+            if core.brush != "hard":
+                piece["brush"] = core.brush
+            self.queue.put((J_PARTIAL if self.sent else J_BEGIN, piece))
+            self.sent = len(points)
+    def run(self):
+        synced = time.monotonic()
+        pending = False
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.fsync_interval)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in batch
+            chunks = []
+            for item in batch:
+                if item is None:
+                    continue
+                kind, value = item
+                if kind == J_RESET:
+                    width, height, base_path = value
+                    body = JOURNAL_SIZE.pack(width, height) + (base_path or "").encode("utf-8")
+                elif kind in (J_OP, J_BEGIN, J_PARTIAL):
+                    body = encode_op(value)
+                else:
+                    body = b""
+                chunks.append(JOURNAL_FRAME.pack(kind, len(body), zlib.crc32(body)) + body)
+            if chunks:
+                self.file.write(b"".join(chunks))
+                self.file.flush()
+                pending = True
+            if pending and (closing or time.monotonic() - synced >= self.fsync_interval):
+                os.fsync(self.file.fileno())
+                synced, pending = time.monotonic(), False
+            if closing:
+                self.file.close()
+                return
+    def close(self, delete=True):
+        self.queue.put(None)
+        self.thread.join()
+        if delete:
+            os.remove(self.path)
+
+def read_journal(path):
+    # (width, height, base image path, ops) of the last document in a journal
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(JOURNAL_MAGIC):
+        raise ValueError(f"{path} is not a Paint journal")
+    size, base_path, ops, redo_ops, partial = None, None, [], [], None
+    offset = len(JOURNAL_MAGIC)
+    while offset + JOURNAL_FRAME.size <= len(data):
+        kind, length, crc = JOURNAL_FRAME.unpack_from(data, offset)
+        body = data[offset + JOURNAL_FRAME.size:offset + JOURNAL_FRAME.size + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            break
+        offset += JOURNAL_FRAME.size + length
+        if kind == J_RESET:
+            size = JOURNAL_SIZE.unpack_from(body)
+            base_path = body[JOURNAL_SIZE.size:].decode("utf-8") or None
+            ops, redo_ops, partial = [], [], None
+        elif kind == J_OP:
+            # A finished op supersedes the pieces of the stroke it completes
+            ops.append(decode_op(body, 0))
+            redo_ops.clear()
+            partial = None
+        elif kind in (J_BEGIN, J_PARTIAL):
+            piece = decode_op(body, 0)
+            if partial is None or kind == J_BEGIN:
+                partial = dict(piece, points=list(piece["points"]))
+            else:
+                partial["points"] += piece["points"]
+        elif kind == J_UNDO and ops:
+            redo_ops.append(ops.pop())
+        elif kind == J_REDO and redo_ops:
+            ops.append(redo_ops.pop())
+    if partial and len(partial["points"]) >= 4:
+        ops.append(partial)
+    if size is None:
+        return None
+    return size[0], size[1], base_path, ops
+
+def process_alive(pid):
+    if os.name == "nt":
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def orphan_journals(journal_dir):
+    # Journals left behind by simulator processes that are no longer running, newest first
+    paths = []
+    for path in glob.glob(os.path.join(journal_dir, "paint-*.w1j")):
+        try:
+            pid = int(os.path.basename(path).split("-")[1])
+        except (IndexError, ValueError):
+            continue
+        if pid != os.getpid() and not process_alive(pid):
+            paths.append(path)
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+def decode_image(path, max_size, result):
+    # Worker side of PaintApp.open_file: publish a reduced preview as soon as possible,
+    # then the full-resolution image. JPEGs get a cheap preview through draft(); formats
+    # without draft support are decoded once and the preview is reduced from that.
+    with Image.open(path) as im:
+        size = im.size
+        factor = max(1, -(-size[0] // max_size[0]), -(-size[1] // max_size[1]))
+        im.draft("RGB", (size[0] // factor, size[1] // factor))
+        drafted = im.size != size
+        decoded = im.convert("RGB")
+    reduce_by = max(1, decoded.width // max(1, size[0] // factor))
+    result["preview"] = (decoded.reduce(reduce_by) if reduce_by > 1 else decoded, size)
+    if drafted:
+        with Image.open(path) as im:
+            decoded = im.convert("RGB")
+    result["image"] = decoded
+
+def save_image(image, path, fmt="PNG", compress_level=6):
+    # Written next to the target and renamed over it, so an interrupted save leaves no half file
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    options = {"compress_level": compress_level} if fmt == "PNG" else {}
+    image.save(path + ".part", fmt, **options)
+    os.replace(path + ".part", path)
+
+def render_stroke_file(path, out_dir, width, height, engine):
+    start = time.perf_counter()
+    with open(path, encoding="utf-8") as f:
+        strokes = [json.loads(line) for line in f if line.strip()]
+    out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(path))[0] + ".png")
+    render_strokes(strokes, width, height, engine).save(out_path, "PNG")
+    return out_path, len(strokes), time.perf_counter() - start
+
+def batch_render(argv):
+    parser = argparse.ArgumentParser(
+        prog=f"{os.path.basename(sys.argv[0])} render",
+        description="Render Paint stroke files (JSON lines, one stroke per line) to PNG."
+    )
+    parser.add_argument("input_dir")
+    parser.add_argument("-o", "--output-dir", help="where PNGs go (default: next to the stroke files)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--pattern", default="*.jsonl")
+    parser.add_argument("--width", type=int, default=340)
+    parser.add_argument("--height", type=int, default=170)
+    parser.add_argument("--engine", choices=sorted(SURFACES), default="pil")
+    parser.add_argument("--report", help="write per-file timings and a summary as JSON lines")
+    args = parser.parse_args(argv)
+    if Image is None:
+        parser.error("Pillow is required for rendering.\nInstall with: pip install pillow")
+    out_dir = args.output_dir or args.input_dir
+    os.makedirs(out_dir, exist_ok=True)
+    paths = iter(sorted(glob.glob(os.path.join(args.input_dir, args.pattern))))
+    report = open(args.report, "w", encoding="utf-8") if args.report else None
+    done_count = failed = 0
+    busy_time = 0.0
+    start = time.perf_counter()
+    # Keep only a couple of files per worker in flight so results stream out as they finish
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        in_flight = {}
+        while True:
+            while len(in_flight) < 2 * args.workers:
+                path = next(paths, None)
+                if path is None:
+                    break
+                in_flight[pool.submit(render_stroke_file, path, out_dir, args.width, args.height, args.engine)] = path
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = in_flight.pop(future)
+                done_count += 1
+                try:
+                    out_path, strokes, seconds = future.result()
+                except Exception as e:
+                    failed += 1
+                    entry = {"file": path, "error": str(e)}
+                    print(f"[{done_count}] {path}: FAILED ({e})", flush=True)
+                else:
+                    busy_time += seconds
+                    entry = {"file": path, "output": out_path, "strokes": strokes, "seconds": round(seconds, 4)}
+                    print(f"[{done_count}] {path} -> {out_path} ({strokes} strokes, {seconds * 1000:.1f} ms)", flush=True)
+                if report:
+                    report.write(json.dumps(entry) + "\n")
+    elapsed = time.perf_counter() - start
+    summary = {
+        "files": done_count,
+        "failed": failed,
+        "workers": args.workers,
+        "seconds": round(elapsed, 3),
+        "files_per_second": round(done_count / elapsed, 2) if elapsed else None,
+        "parallelism": round(busy_time / elapsed, 2) if elapsed else None,
+    }
+    print(f"Rendered {done_count - failed}/{done_count} files in {elapsed:.2f}s "
+          f"({summary['files_per_second']} files/s, {summary['parallelism']}x parallelism over {args.workers} workers)")
+    if report:
+        report.write(json.dumps({"summary": summary}) + "\n")
+        report.close()
+    return 1 if failed else 0
+
+class PaintApp(DraggableWindow):
+    # Input pipeline: moves shorter than min_move pixels are dropped, the rest are batched
+    # per frame_ms frame and optionally smoothed ("catmull-rom") before reaching the core
+    frame_ms = FRAME_MS
+    min_move = 1.0
+    smoothing = None
+    png_compress_level = 6  # 0-9; uncompressed BMP is the fastest choice for quick checkpoints
+    journal_dir = JOURNAL_DIR  # None turns crash journaling off
+    journal_fsync_interval = JOURNAL_FSYNC_INTERVAL
+    journal_serial = 0
+    def __init__(self, master, canvas_width=340, canvas_height=170, engine="pil", history_budget=HISTORY_BUDGET, **kwargs):
+        super().__init__(master, title="Paint", width=384, height=366, **kwargs)
+        self.core = PaintCore(canvas_width, canvas_height, engine, history_budget)
+        self.stroke_item, self.stroke_coords, self.stroke_style = None, [], None
+        self._flush_job = None
+        self.motion_points, self.raw_tail, self.last_raw, self._frame_job = [], [], None, None
+        self.frame_stats = {"events": 0, "dropped": 0, "frames": 0, "points": 0, "frame_ms": 0.0}
+        self._save_thread, self._save_result = None, None
+
+        # --- Menu row (Save button is always shown)
+        menu_row = tk.Frame(self.frame, bg=WIN_BG)
+        menu_row.pack(fill=tk.X, padx=5, pady=(3,0))
+        win1_button(menu_row, text="Open", width=6, command=self.open_file).pack(side=tk.LEFT, padx=2)
+        win1_button(menu_row, text="Save", width=6, command=self.save_to_file).pack(side=tk.LEFT, padx=2)
+        win1_button(menu_row, text="Clear", width=6, command=self.clear_canvas).pack(side=tk.LEFT, padx=2)
+        win1_button(menu_row, text="Redo", width=6, command=self.redo).pack(side=tk.RIGHT, padx=2)
+        win1_button(menu_row, text="Undo", width=6, command=self.undo).pack(side=tk.RIGHT, padx=2)
+        self.bind("<Control-z>", lambda e: self.undo())
+        self.bind("<Control-y>", lambda e: self.redo())
+        self.bind("<Control-x>", lambda e: self.cut_selection())
+        self.bind("<Control-c>", lambda e: self.copy_selection())
+        self.bind("<Control-v>", lambda e: self.paste_clipboard())
+        self.bind("<Delete>", lambda e: self.delete_selection())
+        self.bind("<Escape>", lambda e: self.commit_selection())
+        self.bind("<Return>", lambda e: self.commit_selection())
+
+        # --- Tool row
+        tool_row = tk.Frame(self.frame, bg=WIN_BG)
+        tool_row.pack(fill=tk.X, padx=5, pady=(3,0))
+        tk.Label(tool_row, text="Tool:", bg=WIN_BG, font=FONT).pack(side=tk.LEFT, padx=(2,0))
+        self.tool = "pen"
+        self.tool_var = tk.StringVar(value=self.tool)
+        self.tool_var.trace_add("write", lambda *args: self.set_tool(self.tool_var.get()))
+        for label, tool in [("Pen", "pen"), ("Fill", "fill"), ("Line", "line"), ("Rect", "rect"), ("Oval", "ellipse"), ("Sel", "select")]:
+            tk.Radiobutton(
+                tool_row, text=label, value=tool, variable=self.tool_var, indicatoron=False, width=5,
+                font=FONT, bg=BUTTON_BG, fg=BUTTON_FG, selectcolor=BORDER_LIGHT, bd=1
+            ).pack(side=tk.LEFT, padx=1)
+        win1_button(tool_row, text="+", width=2, command=lambda: self.zoom_at(2, VIEW_WIDTH // 2, VIEW_HEIGHT // 2)).pack(side=tk.RIGHT, padx=1)
+        win1_button(tool_row, text="-", width=2, command=lambda: self.zoom_at(0.5, VIEW_WIDTH // 2, VIEW_HEIGHT // 2)).pack(side=tk.RIGHT, padx=1)
+
+        # --- Toolbar
         toolbar = tk.Frame(self.frame, bg=WIN_BG)
         toolbar.pack(fill=tk.X, padx=5, pady=(3,2))
 
-        win1_button(toolbar, text="Save", width=6, command=self.save_to_file).pack(side=tk.RIGHT, padx=2)
-        win1_button(toolbar, text="Clear", width=6, command=self.clear_canvas).pack(side=tk.RIGHT, padx=2)
         tk.Label(toolbar, text="Color:", bg=WIN_BG, font=FONT).pack(side=tk.LEFT, padx=(2,0))
         for color in ["#000000", "#0000ff", "#ff0000", "#008000", "#ffff00", "#ffa500", "#ffffff"]:
-            cbtn = win1_button(toolbar, width=2, text="   ", command=lambda col=color: self.set_color(col), bg=color)
+            cbtn = win1_button(toolbar, width=2, text="   ", command=lambda col=color: self.color_var.set(col), bg=color)
             cbtn.pack(side=tk.LEFT, padx=1)
         tk.Label(toolbar, text="Width:", bg=WIN_BG, font=FONT).pack(side=tk.LEFT, padx=(6,0))
-        self.width_var = tk.IntVar(value=self.pen_width)
+        self.width_var = tk.IntVar(value=self.core.pen_width)
         w_entry = tk.Spinbox(toolbar, from_=1, to=10, width=2, textvariable=self.width_var, font=FONT, bd=1)
         w_entry.pack(side=tk.LEFT, padx=2)
-        w_entry.bind("<KeyRelease>", lambda e: self.set_width())
-        w_entry.bind("<ButtonRelease-1>", lambda e: self.set_width())
+        self.brush_var = tk.StringVar(value=self.core.brush)
+        tk.Spinbox(toolbar, values=BRUSHES, width=4, textvariable=self.brush_var, font=FONT, bd=1,
+                   state="readonly").pack(side=tk.LEFT, padx=2)
+        self.brush_var.trace_add("write", lambda *args: self.set_brush(self.brush_var.get()))
+        # The core caches the brush; traces keep it current so drawing never reads Tcl variables
+        self.color_var = tk.StringVar(value=self.core.color)
+        self.color_var.trace_add("write", lambda *args: self.set_color(self.color_var.get()))
+        self.width_var.trace_add("write", lambda *args: self.set_width())
+
+        # --- Layer row (layers need the raster, so only with Pillow)
+        self.layer_var = None
+        if self.core.surface:
+            layer_row = tk.Frame(self.frame, bg=WIN_BG)
+            layer_row.pack(fill=tk.X, padx=5, pady=(0,2))
+            tk.Label(layer_row, text="Layer:", bg=WIN_BG, font=FONT).pack(side=tk.LEFT, padx=(2,0))
+            self.layer_var = tk.IntVar(value=1)
+            self.layer_box = tk.Spinbox(layer_row, from_=1, to=1, width=2, textvariable=self.layer_var, font=FONT, bd=1, state="readonly")
+            self.layer_box.pack(side=tk.LEFT, padx=2)
+            for label, action in [("New", "add"), ("Del", "remove"), ("Up", "up"), ("Down", "down")]:
+                win1_button(layer_row, text=label, width=4, command=lambda a=action: self.layer_action(a)).pack(side=tk.LEFT, padx=1)
+            self.visible_var = tk.BooleanVar(value=True)
+            tk.Checkbutton(layer_row, text="Show", variable=self.visible_var, bg=WIN_BG, font=FONT,
+                           activebackground=WIN_BG).pack(side=tk.LEFT, padx=2)
+            self.opacity_var = tk.IntVar(value=100)
+            tk.Spinbox(layer_row, from_=0, to=100, increment=10, width=3, textvariable=self.opacity_var, font=FONT, bd=1).pack(side=tk.RIGHT, padx=2)
+            tk.Label(layer_row, text="Opacity:", bg=WIN_BG, font=FONT).pack(side=tk.RIGHT)
+            self.syncing_layers = False
+            self.layer_var.trace_add("write", lambda *args: self.layer_action("select"))
+            self.visible_var.trace_add("write", lambda *args: self.layer_action("visible"))
+            self.opacity_var.trace_add("write", lambda *args: self.layer_action("opacity"))
 
         # --- Canvas area
         paint_border = tk.Frame(self.frame, bg=BORDER_DARK)
@@ -91,8 +1726,8 @@ class PaintApp(DraggableWindow):
         self.canvas = tk.Canvas(
             paint_border,
             bg="#FFFFFF",
-            width=self.canvas_width,
-            height=self.canvas_height,
+            width=VIEW_WIDTH,
+            height=VIEW_HEIGHT,
             bd=0,
             highlightthickness=0,
             cursor="cross"
@@ -101,66 +1736,1179 @@ class PaintApp(DraggableWindow):
         self.canvas.bind("<ButtonPress-1>", self.start_draw)
         self.canvas.bind("<B1-Motion>", self.draw)
         self.canvas.bind("<ButtonRelease-1>", self.reset_draw)
-        # For saving: memory image
-        if Image:
-            self.image = Image.new("RGB", (self.canvas_width, self.canvas_height), "white")
-            self.draw_pil = ImageDraw.Draw(self.image)
+        # The core's image is what gets saved; when available it is also what the canvas
+        # shows, blitted tile by tile into a single PhotoImage
+        self.image = self.core.image
+        # The photo only ever holds the viewport, however large the document is; view_x/y is
+        # the document pixel at its top-left corner and zoom a power of two
+        self.view_x, self.view_y, self.zoom = 0, 0, 1
+        self.pan_anchor, self._view_job = None, None
+        self.loading = None
+        if self.image:
+            self.photo = tk.PhotoImage(width=VIEW_WIDTH, height=VIEW_HEIGHT)
+            self.canvas.create_image(0, 0, image=self.photo, anchor=tk.NW, tags="raster")
+            self.lod = LodCache(self.core)
         else:
-            self.image = None
-            self.draw_pil = None
+            self.photo = None
+            self.lod = None
+        self.canvas.bind("<ButtonPress-2>", self.start_pan)
+        self.canvas.bind("<ButtonRelease-2>", self.end_pan)
+        self.canvas.bind("<B2-Motion>", self.pan)
+        self.canvas.bind("<MouseWheel>", lambda e: self.zoom_at(2 if e.delta > 0 else 0.5, e.x, e.y))
+        self.canvas.bind("<Button-4>", lambda e: self.zoom_at(2, e.x, e.y))
+        self.canvas.bind("<Button-5>", lambda e: self.zoom_at(0.5, e.x, e.y))
+        # Selection: a marquee rectangle over a document box, and once lifted or pasted a
+        # floating image item that is only composited into the layer on commit
+        self.selection, self.floating, self.select_drag = None, None, None
+        self.marquee = self.canvas.create_rectangle(0, 0, 0, 0, state=tk.HIDDEN, dash=(4, 2))
+        self.edit_menu = tk.Menu(self, tearoff=0, font=FONT)
+        for label, command in [("Cut", self.cut_selection), ("Copy", self.copy_selection),
+                               ("Paste", self.paste_clipboard), ("Delete", self.delete_selection)]:
+            self.edit_menu.add_command(label=label, command=command)
+        self.canvas.bind("<Button-3>", lambda e: self.edit_menu.tk_popup(e.x_root, e.y_root))
+        # Rubber-band previews: one hidden item per shape tool, only ever moved with coords
+        self.shape_start = None
+        self.previews = {
+            "line": self.canvas.create_line(0, 0, 0, 0, state=tk.HIDDEN, capstyle=tk.PROJECTING),
+            "rect": self.canvas.create_rectangle(0, 0, 0, 0, state=tk.HIDDEN),
+            "ellipse": self.canvas.create_oval(0, 0, 0, 0, state=tk.HIDDEN),
+        }
+        self.journal = None
+        self.after_idle(self.start_journal)
+    def start_journal(self):
+        # Offer to recover what a crashed session left behind, then journal this document
+        if not self.journal_dir or not self.winfo_exists():
+            return
+        try:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            orphans = orphan_journals(self.journal_dir)
+            PaintApp.journal_serial += 1
+            path = os.path.join(self.journal_dir, f"paint-{os.getpid()}-{PaintApp.journal_serial}.w1j")
+            self.journal = PaintJournal(path, self.journal_fsync_interval)
+        except OSError:
+            return  # no journal where the directory is not writable
+        self.core.journal = self.journal
+        self.journal.reset(self.core.width, self.core.height, self.core.base_path)
+        # One recovery per window; declined or empty journals are dropped, the rest are left
+        # for the next Paint window
+        for orphan in orphans:
+            try:
+                recovered = read_journal(orphan)
+                when = time.strftime("%H:%M", time.localtime(os.path.getmtime(orphan)))
+            except FileNotFoundError:
+                continue  # another window got to it first
+            except (OSError, ValueError, IndexError, struct.error, zlib.error):
+                recovered = None  # unreadable, so nothing to offer; dropped like an empty one
+            accepted = recovered and recovered[3] and messagebox.askyesno(
+                "Paint", f"Paint closed unexpectedly at {when}.\n"
+                         f"Recover the unsaved drawing ({len(recovered[3])} changes)?", parent=self)
+            if accepted:
+                self.recover(*recovered)
+            try:
+                os.remove(orphan)
+            except OSError:
+                pass
+            if accepted:
+                break
+    def recover(self, width, height, base_path, ops):
+        # Rebuild a journaled document: its base image or a blank page, then its ops, which
+        # also go into this window's own journal
+        self.discard_selection()
+        self.canvas.delete("stroke")
+        try:
+            if Image is not None and base_path and os.path.exists(base_path):
+                image = Image.open(base_path).convert("RGB")
+                self.core.load_image(image, base_path)
+            else:
+                self.core.new_document(width, height)
+            self.core.render(ops)
+        except Exception as e:
+            messagebox.showerror("Paint", f"Error recovering drawing:\n{e}", parent=self)
+        self.image = self.core.image
+        if self.lod:
+            self.lod.clear()
+        self.view_x, self.view_y = 0, 0
+        self.sync_layers()
+        self.refresh_after_history()
+        self.render_view()
+    def destroy(self):
+        # A clean close leaves no journal to recover
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+            self.core.journal = None
+        super().destroy()
     def set_color(self, color):
-        self.current_color = color
+        self.flush_motion()
+        self.core.set_color(color)
     def set_width(self):
+        self.flush_motion()
         try:
-            self.pen_width = int(self.width_var.get())
+            self.core.set_width(int(self.width_var.get()))
         except Exception:
-            self.pen_width = 2
+            self.core.set_width(2)
+    def set_brush(self, brush):
+        self.flush_motion()
+        self.core.set_brush(brush)
+    def set_tool(self, tool):
+        self.flush_motion()
+        self.core.end_stroke()
+        self.commit_selection()
+        self.tool = tool
     def clear_canvas(self):
-        self.canvas.delete("all")
-        if self.image:
-            self.image.paste("white", [0, 0, self.canvas_width, self.canvas_height])
-            self.draw_pil = ImageDraw.Draw(self.image)
+        self.commit_selection()
+        self.canvas.delete("stroke")
+        self.core.clear()
+        self.flush_pending()
+    def undo(self):
+        if self.floating:
+            # Undoing a move drops the floating copy and puts back what was lifted
+            lifted = self.floating["lifted"]
+            self.discard_selection()
+            if not lifted:
+                return
+        else:
+            self.commit_selection()
+        if self.core.undo():
+            self.refresh_after_history()
+    def redo(self):
+        self.commit_selection()
+        if self.core.redo():
+            self.refresh_after_history()
+    def layer_action(self, action):
+        if self.syncing_layers:
+            return
+        self.flush_motion()
+        self.commit_selection()
+        core = self.core
+        try:
+            if action == "select":
+                core.select_layer(min(max(int(self.layer_var.get()), 1), len(core.layers)) - 1)
+            elif action == "visible":
+                core.set_layer_visible(self.visible_var.get())
+            elif action == "opacity":
+                core.set_layer_opacity(round(int(self.opacity_var.get()) * 255 / 100))
+        except (tk.TclError, ValueError):
+            return  # half-typed spinbox value
+        if action == "add":
+            core.add_layer()
+        elif action == "remove":
+            core.remove_layer()
+        elif action == "up":
+            core.move_layer(core.active + 1)
+        elif action == "down":
+            core.move_layer(core.active - 1)
+        self.sync_layers()
+        self.flush_pending()
+    def sync_layers(self):
+        # Show the core's layer stack in the controls without their traces firing edits
+        if self.layer_var is None:
+            return
+        layer = self.core.layers[self.core.active]
+        self.syncing_layers = True
+        self.layer_box.config(to=len(self.core.layers))
+        self.layer_var.set(self.core.active + 1)
+        self.visible_var.set(layer.visible)
+        self.opacity_var.set(round(layer.opacity * 100 / 255))
+        self.syncing_layers = False
+    def refresh_after_history(self):
+        self.canvas.delete("stroke")
+        self.sync_layers()
+        if self.photo:
+            self.flush_pending()
+        else:
+            for op in self.core.document():
+                self.create_vector(op)
+    def create_vector(self, op):
+        # Without Pillow there is no raster, so strokes and shapes stay canvas items
+        if "shape" in op:
+            create = {"line": self.canvas.create_line, "rect": self.canvas.create_rectangle,
+                      "ellipse": self.canvas.create_oval}[op["shape"]]
+            color = {"fill": op["color"]} if op["shape"] == "line" else {"outline": op["color"]}
+            create(*op["box"], width=op["width"], tags="stroke", **color)
+        elif "points" in op:
+            self.canvas.create_line(*op["points"], fill=op["color"], width=op["width"],
+                                    capstyle=tk.PROJECTING, joinstyle=tk.ROUND, tags="stroke")
+    def to_doc(self, x, y):
+        return int(self.view_x + x / self.zoom), int(self.view_y + y / self.zoom)
+    def to_canvas(self, coords):
+        z, vx, vy = self.zoom, self.view_x, self.view_y
+        return [(c - vx) * z if i % 2 == 0 else (c - vy) * z for i, c in enumerate(coords)]
     def start_draw(self, event):
-        self.last_x, self.last_y = event.x, event.y
+        if self.loading:
+            return
+        if self.tool == "select":
+            self.select_press(event)
+            return
+        x, y = self.to_doc(event.x, event.y)
+        if self.tool == "fill":
+            if self.core.fill(x, y):
+                self.flush_pending()
+            return
+        if self.tool in self.previews:
+            self.shape_start = (x, y)
+            preview = self.previews[self.tool]
+            color = {"fill": self.core.color} if self.tool == "line" else {"outline": self.core.color}
+            self.canvas.itemconfigure(preview, state=tk.NORMAL, width=max(1, self.core.pen_width * self.zoom), **color)
+            self.canvas.coords(preview, event.x, event.y, event.x, event.y)
+            self.canvas.tag_raise(preview)
+            self.shape_anchor = (event.x, event.y)
+            self.shape_end = self.shape_start
+            return
+        self.core.begin_stroke(x, y)
+        self.stroke_item, self.stroke_coords, self.stroke_style = None, [], None
+        self.last_raw = (x, y)
+        self.raw_tail = [self.last_raw, self.last_raw]
     def draw(self, event):
-        if self.last_x is not None and self.last_y is not None:
-            self.set_width()
-            self.canvas.create_line(
-                self.last_x, self.last_y, event.x, event.y,
-                fill=self.current_color,
-                width=self.pen_width,
-                capstyle=tk.PROJECTING,
-                smooth=False
-            )
-            if self.draw_pil:
-                self.draw_pil.line(
-                    [self.last_x, self.last_y, event.x, event.y],
-                    fill=self.current_color,
-                    width=self.pen_width
+        if self.select_drag is not None:
+            self.select_motion(event)
+            return
+        if self.shape_start is not None:
+            self.shape_end = self.to_doc(event.x, event.y)
+            self.canvas.coords(self.previews[self.tool], *self.shape_anchor, event.x, event.y)
+            return
+        if self.core.last is None:
+            return
+        self.frame_stats["events"] += 1
+        x, y = self.to_doc(event.x, event.y)
+        dx, dy = x - self.last_raw[0], y - self.last_raw[1]
+        if dx * dx + dy * dy < self.min_move * self.min_move:
+            self.frame_stats["dropped"] += 1
+            return
+        self.last_raw = (x, y)
+        self.motion_points.append(self.last_raw)
+        if self._frame_job is None:
+            self._frame_job = self.after(self.frame_ms, self.flush_motion)
+    def flush_motion(self, final=False):
+        # Everything that arrived this frame becomes one core update and one coords call
+        if self._frame_job is not None:
+            self.after_cancel(self._frame_job)
+            self._frame_job = None
+        if self.core.last is None:
+            self.motion_points.clear()
+            return
+        started = time.perf_counter()
+        points = []
+        if self.smoothing == "catmull-rom":
+            tail = self.raw_tail
+            for point in self.motion_points:
+                tail.append(point)
+                if len(tail) == 4:
+                    steps = min(8, max(1, int(abs(tail[2][0] - tail[1][0]) + abs(tail[2][1] - tail[1][1])) // 4))
+                    points += catmull_rom(*tail, steps)
+                    del tail[0]
+            if final and len(tail) == 3:
+                points += catmull_rom(*tail, tail[2], 1)
+        else:
+            for point in self.motion_points:
+                points += point
+        self.motion_points.clear()
+        if not points:
+            return
+        last_x, last_y = self.core.last
+        for i in range(0, len(points), 2):
+            self.core.extend_stroke(points[i], points[i + 1])
+        if self.journal:
+            self.journal.progress(self.core)
+        # One growing polyline per stroke; a new item only when the brush changes or the chunk is full.
+        # Dab brushes have no canvas equivalent, so they show only through the raster.
+        style = (self.core.color, self.core.pen_width)
+        if self.zoom != 1 or self.view_x or self.view_y:
+            last_x, last_y, *points = self.to_canvas([last_x, last_y] + points)
+        if self.core.brush == "hard" or not self.photo:
+            if self.stroke_item is None or style != self.stroke_style or len(self.stroke_coords) >= 2 * STROKE_CHUNK:
+                self.stroke_coords = [last_x, last_y] + points
+                self.stroke_style = style
+                self.stroke_item = self.canvas.create_line(
+                    *self.stroke_coords,
+                    fill=self.core.color,
+                    width=max(1, self.core.pen_width * self.zoom),
+                    capstyle=tk.PROJECTING,
+                    joinstyle=tk.ROUND,
+                    smooth=False,
+                    tags="stroke"
                 )
-            self.last_x, self.last_y = event.x, event.y
+            else:
+                self.stroke_coords += points
+                self.canvas.coords(self.stroke_item, self.stroke_coords)
+        # The raster copy is drawn in bulk when idle, off the motion path
+        if self.core.pending and self._flush_job is None:
+            self._flush_job = self.after_idle(self.flush_pending)
+        stats = self.frame_stats
+        stats["frames"] += 1
+        stats["points"] += len(points) // 2
+        stats["frame_ms"] = (time.perf_counter() - started) * 1000
     def reset_draw(self, event):
-        self.last_x, self.last_y = None, None
+        if self.tool == "select":
+            self.select_release(event)
+            return
+        if self.shape_start is not None:
+            # The shape is only committed to the core (and raster) on release
+            self.canvas.itemconfigure(self.previews[self.tool], state=tk.HIDDEN)
+            box = self.shape_start + self.shape_end
+            self.shape_start = None
+            if box[:2] != box[2:]:
+                self.core.shape(self.tool, box)
+                if self.photo:
+                    self.flush_pending()
+                else:
+                    self.create_vector(self.core.history[-1])
+            return
+        self.flush_motion(final=True)
+        self.core.end_stroke()
+        self.stroke_item, self.stroke_coords, self.stroke_style = None, [], None
+        self.flush_pending()
+        # The stroke now lives in the raster, so its vector items can go
+        if self.photo:
+            self.canvas.delete("stroke")
+    def select_press(self, event):
+        if not self.photo:
+            return
+        x, y = self.to_doc(event.x, event.y)
+        box = self.floating_box() or self.selection
+        if box and box[0] <= x < box[2] and box[1] <= y < box[3]:
+            if not self.floating:
+                self.lift_selection(self.core.cut(box), box[0], box[1], lifted=True)
+            self.select_drag = ("move", event.x, event.y, self.floating["x"], self.floating["y"])
+            return
+        self.commit_selection()
+        self.select_drag = ("marquee", x, y)
+        self.canvas.coords(self.marquee, event.x, event.y, event.x, event.y)
+        self.canvas.itemconfigure(self.marquee, state=tk.NORMAL)
+        self.canvas.tag_raise(self.marquee)
+    def select_motion(self, event):
+        if self.select_drag[0] == "marquee":
+            self.canvas.coords(self.marquee, *self.to_canvas(self.select_drag[1:]), event.x, event.y)
+            return
+        # Moving the floating selection is two canvas.move calls, whatever its size
+        _, start_x, start_y, float_x, float_y = self.select_drag
+        floating = self.floating
+        x = float_x + round((event.x - start_x) / self.zoom)
+        y = float_y + round((event.y - start_y) / self.zoom)
+        if (x, y) != (floating["x"], floating["y"]):
+            dx, dy = (x - floating["x"]) * self.zoom, (y - floating["y"]) * self.zoom
+            self.canvas.move(floating["item"], dx, dy)
+            self.canvas.move(self.marquee, dx, dy)
+            floating["x"], floating["y"] = x, y
+    def select_release(self, event):
+        drag, self.select_drag = self.select_drag, None
+        if drag is None or drag[0] != "marquee":
+            return
+        x0, y0 = drag[1:]
+        x1, y1 = self.to_doc(event.x, event.y)
+        box = (max(min(x0, x1), 0), max(min(y0, y1), 0),
+               min(max(x0, x1), self.core.width), min(max(y0, y1), self.core.height))
+        if box[0] < box[2] and box[1] < box[3]:
+            self.selection = box
+            self.canvas.coords(self.marquee, *self.to_canvas(box))
+        else:
+            self.selection = None
+            self.canvas.itemconfigure(self.marquee, state=tk.HIDDEN)
+    def floating_box(self):
+        floating = self.floating
+        if floating is None:
+            return None
+        return (floating["x"], floating["y"], floating["x"] + floating["image"].width, floating["y"] + floating["image"].height)
+    def lift_selection(self, image, x, y, lifted=False):
+        # Show image as one floating PhotoImage item at document position (x, y)
+        self.flush_pending()
+        shown = image
+        if self.zoom != 1:
+            shown = image.resize((max(1, round(image.width * self.zoom)), max(1, round(image.height * self.zoom))), Image.NEAREST)
+        if shown.mode == "RGB":
+            photo = tk.PhotoImage(master=self, data=ppm_data(shown))
+        else:
+            data = io.BytesIO()
+            shown.save(data, "PNG", compress_level=0)
+            photo = tk.PhotoImage(master=self, data=data.getvalue())
+        item = self.canvas.create_image(*self.to_canvas([x, y]), image=photo, anchor=tk.NW, tags="floating")
+        self.floating = {"image": image, "photo": photo, "item": item, "x": x, "y": y, "lifted": lifted}
+        self.selection = None
+        self.canvas.coords(self.marquee, *self.to_canvas(self.floating_box()))
+        self.canvas.itemconfigure(self.marquee, state=tk.NORMAL)
+        self.canvas.tag_raise(self.marquee)
+    def commit_selection(self):
+        floating = self.floating
+        self.discard_selection()
+        if floating is not None:
+            self.core.paste(floating["image"], floating["x"], floating["y"])
+            self.flush_pending()
+    def discard_selection(self):
+        if self.floating is not None:
+            self.canvas.delete(self.floating["item"])
+        self.floating, self.selection, self.select_drag = None, None, None
+        self.canvas.itemconfigure(self.marquee, state=tk.HIDDEN)
+    def copy_selection(self):
+        if self.floating:
+            CLIPBOARD.set_image(self.floating["image"], self)
+        elif self.selection and self.core.surface:
+            CLIPBOARD.set_image(self.core.copy_region(self.selection), self)
+    def cut_selection(self):
+        if self.floating:
+            # What was lifted is already cut from the layer
+            CLIPBOARD.set_image(self.floating["image"], self)
+            self.discard_selection()
+        elif self.selection and self.core.surface:
+            CLIPBOARD.set_image(self.core.cut(self.selection), self)
+            self.discard_selection()
+            self.flush_pending()
+    def delete_selection(self):
+        if self.floating:
+            self.discard_selection()
+        elif self.selection and self.core.surface:
+            self.core.cut(self.selection)
+            self.discard_selection()
+            self.flush_pending()
+    def paste_clipboard(self):
+        if CLIPBOARD.image is None or not self.photo:
+            return
+        self.commit_selection()
+        self.tool_var.set("select")
+        self.lift_selection(CLIPBOARD.image, self.view_x, self.view_y)
+    def flush_pending(self):
+        if self._flush_job is not None:
+            self.after_cancel(self._flush_job)
+            self._flush_job = None
+        self.core.flush()
+        if self.photo:
+            boxes = self.core.take_dirty()
+            self.lod.invalidate(boxes)
+            if self.zoom != 1:
+                self.render_view()
+                return
+            if len(boxes) > 16:
+                # Large updates (fills, undo) go to the photo as one put of their bounding box
+                boxes = [(min(b[0] for b in boxes), min(b[1] for b in boxes),
+                          max(b[2] for b in boxes), max(b[3] for b in boxes))]
+            self.blit(boxes)
+    def blit(self, boxes):
+        # Put document regions into the photo, clipped to the viewport
+        vx, vy = self.view_x, self.view_y
+        for x0, y0, x1, y1 in boxes:
+            x0, y0 = max(x0, vx), max(y0, vy)
+            x1, y1 = min(x1, vx + VIEW_WIDTH, self.core.width), min(y1, vy + VIEW_HEIGHT, self.core.height)
+            if x0 < x1 and y0 < y1:
+                self.photo.put(self.core.ppm((x0, y0, x1, y1)), to=(x0 - vx, y0 - vy))
+    def render_view(self):
+        # Recompose the whole viewport: a crop at 1:1, a nearest-neighbour blow-up of a small
+        # crop when zoomed in, and cached pyramid tiles when zoomed out
+        if self._view_job is not None:
+            self.after_cancel(self._view_job)
+            self._view_job = None
+        if not self.photo:
+            return
+        self.photo.blank()
+        if self.zoom == 1:
+            self.blit([(0, 0, self.core.width, self.core.height)])
+            return
+        if self.zoom > 1:
+            z = int(self.zoom)
+            x0, y0 = self.view_x, self.view_y
+            x1 = min(self.core.width, x0 + -(-VIEW_WIDTH // z))
+            y1 = min(self.core.height, y0 + -(-VIEW_HEIGHT // z))
+            if x0 < x1 and y0 < y1:
+                region = self.core.composite((x0, y0, x1, y1))
+                self.photo.put(ppm_data(region.resize(((x1 - x0) * z, (y1 - y0) * z), Image.NEAREST)), to=(0, 0))
+            return
+        level = round(math.log2(1 / self.zoom))
+        lx, ly = self.view_x >> level, self.view_y >> level
+        lw, lh = self.lod.level_size(level)
+        frame = Image.new("RGB", (min(VIEW_WIDTH, lw - lx), min(VIEW_HEIGHT, lh - ly)), "white")
+        for ty in range(ly // TILE_SIZE, (ly + frame.height - 1) // TILE_SIZE + 1):
+            for tx in range(lx // TILE_SIZE, (lx + frame.width - 1) // TILE_SIZE + 1):
+                frame.paste(self.lod.tile(level, tx, ty), (tx * TILE_SIZE - lx, ty * TILE_SIZE - ly))
+        self.photo.put(ppm_data(frame), to=(0, 0))
+    def schedule_view(self):
+        # Pan and zoom events arriving faster than Tk can repaint share one render
+        if self._view_job is None:
+            self._view_job = self.after_idle(self.render_view)
+    def set_view(self, x, y):
+        max_x = max(0, self.core.width - int(VIEW_WIDTH / self.zoom))
+        max_y = max(0, self.core.height - int(VIEW_HEIGHT / self.zoom))
+        self.view_x, self.view_y = min(max(int(x), 0), max_x), min(max(int(y), 0), max_y)
+        self.schedule_view()
+    def start_pan(self, event):
+        self.commit_selection()
+        if self.photo:
+            self.pan_anchor = (event.x, event.y, self.view_x, self.view_y)
+    def end_pan(self, event):
+        self.pan_anchor = None
+    def pan(self, event):
+        if self.pan_anchor is None or self.core.last is not None:
+            return
+        x, y, vx, vy = self.pan_anchor
+        self.set_view(vx - (event.x - x) / self.zoom, vy - (event.y - y) / self.zoom)
+    def zoom_at(self, factor, x, y):
+        # Keep the document point under (x, y) in place
+        zoom = min(max(self.zoom * factor, MIN_ZOOM), MAX_ZOOM)
+        if not self.photo or zoom == self.zoom or self.core.last is not None or self.shape_start is not None:
+            return
+        self.commit_selection()
+        doc_x, doc_y = self.view_x + x / self.zoom, self.view_y + y / self.zoom
+        self.zoom = zoom
+        self.set_view(doc_x - x / zoom, doc_y - y / zoom)
     def save_to_file(self):
-        if not self.image:
-            messagebox.showerror("Paint", "Pillow is required for saving images.\nInstall with: pip install pillow")
+        if self._save_thread is not None:
+            messagebox.showinfo("Paint", "Still saving the previous file, please wait.")
             return
+        self.commit_selection()
+        self.flush_pending()
         file_path = filedialog.asksaveasfilename(
             defaultextension=".png",
-            filetypes=[("PNG Image", "*.png"), ("All Files", "*.*")]
+            filetypes=[("PNG Image", "*.png"), ("BMP Image (fast)", "*.bmp"),
+                       ("Paint Strokes", "*" + STROKE_EXT), ("All Files", "*.*")]
         )
-        if file_path:
+        if not file_path:
+            return
+        # Snapshot on the UI thread, encode and write on a worker thread
+        if file_path.lower().endswith(STROKE_EXT):
+            ops, size = self.core.document(), (self.core.width, self.core.height)
+            self.start_save(lambda: save_strokes(file_path, ops, *size), "Strokes saved successfully!", "Error saving strokes")
+            return
+        if not self.core.surface:
+            messagebox.showerror("Paint", "Pillow is required for saving images.\nInstall with: pip install pillow")
+            return
+        snapshot = self.core.flattened()
+        fmt = "BMP" if file_path.lower().endswith(".bmp") else "PNG"
+        level = self.png_compress_level
+        self.start_save(lambda: save_image(snapshot, file_path, fmt, level), "Image saved successfully!", "Error saving image")
+    def start_save(self, job, done_message, error_message):
+        def run():
             try:
-                self.image.save(file_path, "PNG")
-                messagebox.showinfo("Paint", "Image saved successfully!")
+                job()
+                self._save_result = (True, done_message)
             except Exception as e:
-                messagebox.showerror("Paint", f"Error saving image:\n{e}")
+                self._save_result = (False, f"{error_message}:\n{e}")
+        self._save_thread = threading.Thread(target=run, daemon=True)
+        self._save_thread.start()
+        self.title_label.config(text="Paint - Saving...")
+        self.after(50, self.poll_save)
+    def poll_save(self):
+        # Runs on the Tk thread via after, so it may touch widgets; the worker never does
+        if not self.winfo_exists():
+            return
+        if self._save_thread.is_alive():
+            self.after(50, self.poll_save)
+            return
+        self._save_thread = None
+        self.title_label.config(text="Paint")
+        ok, message = self._save_result
+        if ok:
+            messagebox.showinfo("Paint", message)
+        else:
+            messagebox.showerror("Paint", message)
+    def open_file(self):
+        if self.loading:
+            return
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Images and Strokes", "*.png *.jpg *.jpeg *.bmp *" + STROKE_EXT), ("Paint Strokes", "*" + STROKE_EXT),
+                       ("Images", "*.png *.jpg *.jpeg *.bmp"), ("All Files", "*.*")]
+        )
+        if not file_path:
+            return
+        self.discard_selection()
+        if not file_path.lower().endswith(STROKE_EXT):
+            self.open_image(file_path)
+            return
+        # Decode every record before touching the drawing, so a bad file leaves it as it was
+        try:
+            with StrokeDocument(file_path) as doc:
+                ops, size = list(doc), (doc.width, doc.height)
+        except Exception as e:
+            messagebox.showerror("Paint", f"Error opening file:\n{e}")
+            return
+        self.canvas.delete("stroke")
+        # The document's own size, so strokes drawn on a larger page are not clipped
+        self.core.new_document(*size)
+        try:
+            self.core.render(ops)
+        except Exception as e:
+            messagebox.showerror("Paint", f"Error opening file:\n{e}")
+        self.image = self.core.image
+        if self.lod:
+            self.lod.clear()
+        self.view_x, self.view_y = 0, 0
+        self.refresh_after_history()
+        self.render_view()
+    def open_image(self, file_path):
+        if not self.photo:
+            messagebox.showerror("Paint", "Pillow is required for opening images.\nInstall with: pip install pillow")
+            return
+        # Decode on a worker thread; the Tk thread shows the preview, then the full image
+        self.loading = {"path": file_path}
+        worker = threading.Thread(target=self.decode_worker, args=(file_path, self.loading), daemon=True)
+        self.loading["thread"] = worker
+        worker.start()
+        self.title_label.config(text="Paint - Loading...")
+        self.after(30, self.poll_load)
+    def decode_worker(self, path, result):
+        try:
+            decode_image(path, (VIEW_WIDTH, VIEW_HEIGHT), result)
+            result["surfaces"] = self.core.image_surfaces(result["image"])
+        except Exception as e:
+            result["error"] = e
+    def poll_load(self):
+        if not self.winfo_exists():
+            return
+        result = self.loading
+        preview = result.pop("preview", None)
+        if preview:
+            self.show_preview(*preview)
+        if "error" in result or "surfaces" in result or not result["thread"].is_alive():
+            self.loading = None
+            self.title_label.config(text="Paint")
+            if "surfaces" in result:
+                path = result["path"]
+                self.canvas.delete("stroke")
+                self.core.load_image(result["image"], path, result["surfaces"])
+                self.image = self.core.image
+                self.sync_layers()
+                self.lod.clear()
+                self.view_x, self.view_y = 0, 0
+                self.render_view()
+            else:
+                messagebox.showerror("Paint", f"Error opening image:\n{result.get('error', 'unknown error')}")
+            return
+        self.after(30, self.poll_load)
+    def show_preview(self, preview, size):
+        # Stretch the part of the preview under the viewport over the viewport
+        sx, sy = preview.width / size[0], preview.height / size[1]
+        w, h = min(VIEW_WIDTH, size[0] - self.view_x), min(VIEW_HEIGHT, size[1] - self.view_y)
+        if w <= 0 or h <= 0:
+            return
+        box = (self.view_x * sx, self.view_y * sy, (self.view_x + w) * sx, (self.view_y + h) * sy)
+        self.photo.blank()
+        self.photo.put(ppm_data(preview.resize((w, h), Image.NEAREST, box=box)), to=(0, 0))
+
+def map_file(path):
+    # A read-only mmap of a file, or b"" for an empty one, which can't be mapped
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class PieceTable:
+    # Editable byte string over an immutable original (normally an mmap of the opened file)
+    # and an append-only add buffer. The document is a list of (buffer, start, length)
+    # pieces, 0 being the original and 1 the add buffer; edits only split pieces and append
+    # to the add buffer, so memory grows with the edits rather than with the file. Pieces
+    # are kept in blocks of up to block_size, so an edit costs O(blocks + block_size).
+    block_size = 64
+    def __init__(self, original=b"", path=None):
+        self.original = original
+        self.path = path  # the file original maps, if any
+        self.added = bytearray()
+        self.set_pieces([(0, 0, len(original))] if len(original) else [])
+    @classmethod
+    def open(cls, path):
+        return cls(map_file(path), path)
+    def set_pieces(self, pieces):
+        size = self.block_size
+        self.blocks = [pieces[k:k + size] for k in range(0, len(pieces), size)] or [[]]
+        self.totals = [sum(map(itemgetter(2), block)) for block in self.blocks]
+        self.reindex()
+    def reindex(self, first=0):
+        # Block start offsets (and one past the last block) from block first on
+        if not first:
+            self.block_starts = [0]
+        self.block_starts[first:] = accumulate(self.totals[first:], initial=self.block_starts[first])
+        self.length = self.block_starts[-1]
+    @property
+    def pieces(self):
+        return list(chain.from_iterable(self.blocks))
+    def __len__(self):
+        return self.length
+    def find_block(self, offset):
+        return min(bisect.bisect_right(self.block_starts, offset) - 1, len(self.blocks) - 1)
+    def span(self, start, end):
+        # The pieces covering [start, end), trimmed to it
+        start, end = max(start, 0), min(end, self.length)
+        pieces = []
+        if start >= end:
+            return pieces
+        b = self.find_block(start)
+        offset = self.block_starts[b]
+        for block in self.blocks[b:]:
+            for which, piece_start, length in block:
+                if offset + length > start:
+                    low, high = max(start - offset, 0), min(end - offset, length)
+                    pieces.append((which, piece_start + low, high - low))
+                offset += length
+                if offset >= end:
+                    return pieces
+        return pieces
+    def read(self, start, end):
+        return self.join(self.span(start, end))
+    def splice(self, start, end, pieces):
+        # Put pieces in place of [start, end); returns the pieces taken out. Only the blocks
+        # the edit touches are flattened, spliced and cut back into even blocks
+        first, last = self.find_block(start), self.find_block(end)
+        if last + 1 < len(self.blocks) and len(self.blocks[last]) < self.block_size // 2:
+            last += 1  # fold a shrunken block into its neighbour
+        local = list(chain.from_iterable(self.blocks[first:last + 1]))
+        base = self.block_starts[first]
+        local, removed = splice_pieces(local, start - base, end - base, pieces)
+        count = -(-len(local) // self.block_size)
+        size = -(-len(local) // count) if count else 1
+        blocks = [local[k:k + size] for k in range(0, len(local), size)]
+        if not blocks and len(self.blocks) == last - first + 1:
+            blocks = [[]]
+        self.blocks[first:last + 1] = blocks
+        self.totals[first:last + 1] = [sum(map(itemgetter(2), block)) for block in blocks]
+        self.reindex(first)
+        return removed
+    def replace(self, start, end, data):
+        # Returns the pieces taken out and put in, which is all an undo step needs
+        new = [(1, len(self.added), len(data))] if data else []
+        self.added += data
+        return self.splice(start, end, new), new
+    def join(self, pieces):
+        return b"".join((self.added if which else self.original)[piece_start:piece_start + length]
+                        for which, piece_start, length in pieces)
+    def line_start(self, offset, limit=None):
+        # Start of the line holding offset, looking back at most limit bytes
+        stop = 0 if limit is None else max(0, offset - limit)
+        pos = offset
+        while pos > stop:
+            low = max(stop, pos - 65536)
+            i = self.read(low, pos).rfind(b"\n")
+            if i >= 0:
+                return low + i + 1
+            pos = low
+        return stop
+    def next_line(self, offset, limit=None):
+        # Start of the line after the one holding offset, looking ahead at most limit bytes
+        stop = self.length if limit is None else min(self.length, offset + limit)
+        pos = offset
+        while pos < stop:
+            high = min(stop, pos + 65536)
+            i = self.read(pos, high).find(b"\n")
+            if i >= 0:
+                return pos + i + 1
+            pos = high
+        return stop
+    def search(self, regex, start, end):
+        # Matches of regex starting in [start, end), which are line starts, as (base, data, hits)
+        # with offsets into data = the bytes from base. A byte either side of the slice lets
+        # anchors, \b and lookarounds see the document rather than the slice, and an empty match
+        # at end is left to the scan that starts there
+        base = max(start - 1, 0)
+        data = self.read(base, min(end + 1, self.length))
+        stop = end - base if end < self.length else len(data) + 1
+        hits = []
+        for m in regex.finditer(data, start - base):
+            if m.start() >= stop:
+                break
+            hits.append(m)
+        return base, data, hits
+    def edges_agree(self, regex, data, pos, end):
+        # Whether regex finds the same matches in data = [pos, end) taken alone as in the
+        # document along its first and last lines, the only places the two can differ
+        first = data.find(b"\n") + 1 or len(data)
+        last = data.rfind(b"\n", 0, len(data) - 1) + 1
+        for a, b in ((0, first), (last, len(data))):
+            plain = []
+            for m in regex.finditer(data, a):
+                if m.start() >= b and b < len(data):
+                    break
+                plain.append(m.span())
+            base, _, hits = self.search(regex, pos + a, pos + b)
+            if plain != [(base + m.start() - pos, base + m.end() - pos) for m in hits]:
+                return False
+        return True
+    def sub(self, regex, repl, size=LOAD_CHUNK):
+        # regex.subn over the whole document in line-aligned chunks, rebuilding the piece list
+        # in one pass: chunks with a hit become one add-buffer piece, the rest keep theirs.
+        # subn takes a chunk for the whole string, so \A, \Z, $ or an empty match at its edges
+        # would hit at every chunk boundary; such a chunk is substituted hit by hit from search
+        pieces, count, pos = [], 0, 0
+        literal = b"\\" not in repl
+        while pos < self.length:
+            end = self.next_line(min(pos + size, self.length))
+            data = self.read(pos, end)
+            if self.edges_agree(regex, data, pos, end):
+                data, n = regex.subn(repl, data)
+            else:
+                base, data, hits = self.search(regex, pos, end)
+                out, last = [], pos - base
+                for m in hits:
+                    out += data[last:m.start()], repl if literal else m.expand(repl)
+                    last = m.end()
+                # A match that ran into the next line takes its chunk on to where it ended
+                end = max(end, base + last)
+                out.append(data[last:end - base])
+                data, n = b"".join(out), len(hits)
+            if n:
+                if data:
+                    pieces.append((1, len(self.added), len(data)))
+                    self.added += data
+                count += n
+            else:
+                pieces.extend(self.span(pos, end))
+            pos = end
+        self.set_pieces(pieces)
+        return count
+    def chunks(self, size=LOAD_CHUNK):
+        for start in range(0, self.length, size):
+            yield self.read(start, start + size)
+    def snapshot(self):
+        # Frozen copy of the piece list sharing both buffers; safe to read from another thread
+        # while this table keeps being edited, since the add buffer only ever grows
+        copy = PieceTable.__new__(PieceTable)
+        copy.original, copy.added = self.original, self.added
+        copy.blocks, copy.totals = list(self.blocks), list(self.totals)
+        copy.block_starts, copy.length = list(self.block_starts), self.length
+        return copy
+    def repoint(self, lists):
+        # Piece lists (undo history, say) re-pointed for when a copy of the document becomes
+        # the original: at where their text sits in the document now, or, for text it no
+        # longer holds, at a copy appended to the add buffer
+        runs, pos = [], 0
+        for buffer, start, length in self.pieces:
+            if buffer == 0:
+                runs.append((start, pos, length))
+            pos += length
+        runs.sort()
+        firsts = [run[0] for run in runs]
+        result = []
+        for pieces in lists:
+            out = []
+            for buffer, start, length in pieces:
+                if buffer:
+                    out.append((buffer, start, length))
+                    continue
+                end = start + length
+                while start < end:
+                    i = bisect.bisect_right(firsts, start) - 1
+                    if i >= 0 and start < runs[i][0] + runs[i][2]:
+                        stop = min(end, runs[i][0] + runs[i][2])
+                        out.append((0, runs[i][1] + start - runs[i][0], stop - start))
+                    else:
+                        stop = min(end, firsts[i + 1]) if i + 1 < len(runs) else end
+                        out.append((1, len(self.added), stop - start))
+                        self.added += self.original[start:stop]
+                    start = stop
+            result.append(merge_pieces(out))
+        return result
+    def rebase(self, original, path):
+        # original holds exactly the document's text, e.g. the file it was just saved to
+        self.original, self.path = original, path
+        self.set_pieces([(0, 0, len(original))] if len(original) else [])
+    def close(self):
+        if isinstance(self.original, mmap.mmap):
+            self.original.close()
+
+def splice_pieces(pieces, start, end, new):
+    # A flat piece list with [start, end) replaced by new, and the pieces taken out
+    starts = list(accumulate(map(itemgetter(2), pieces), initial=0))
+    def cut(offset):
+        # Index of the piece starting at offset, splitting the one across it if needed
+        i = bisect.bisect_right(starts, offset) - 1
+        if i >= len(pieces):
+            return len(pieces)
+        inner = offset - starts[i]
+        if inner:
+            which, piece_start, length = pieces[i]
+            pieces[i:i + 1] = [(which, piece_start, inner), (which, piece_start + inner, length - inner)]
+            starts.insert(i + 1, offset)
+            i += 1
+        return i
+    i, j = cut(start), cut(end)
+    removed = pieces[i:j]
+    if i:
+        # So that typing keeps growing one piece
+        i -= 1
+        new = [pieces[i]] + list(new)
+    pieces[i:j] = merge_pieces(new)
+    return pieces, removed
+
+def merge_pieces(pieces):
+    # Coalesce pieces that continue each other in the same buffer, such as a run of typing
+    merged = []
+    for piece in pieces:
+        if merged and merged[-1][0] == piece[0] and merged[-1][1] + merged[-1][2] == piece[1]:
+            merged[-1] = (piece[0], merged[-1][1], merged[-1][2] + piece[2])
+        else:
+            merged.append(piece)
+    return merged
+
+class EditJournal:
+    # Notepad's undo history as deltas over a PieceTable: [start, removed pieces, inserted
+    # pieces, removed length, inserted length]. Pieces point into buffers that never change,
+    # so no text is copied. Keystrokes within group_gap of each other make one undo group,
+    # in which runs of typing, backspacing or deleting merge into one delta; past budget
+    # bytes the oldest groups are dropped.
+    piece_cost = 64  # rough bytes per journaled piece tuple
+    group_deltas = 64  # an unbroken burst of keystrokes still splits into groups this long
+    def __init__(self, doc, budget=EDIT_BUDGET, group_gap=EDIT_GROUP_GAP):
+        self.doc, self.budget, self.group_gap = doc, budget, group_gap
+        self.groups = deque()
+        self.redo_groups = []
+        self.used = 0
+        self.last_time = None
+    def cost(self, delta):
+        return self.piece_cost * (1 + len(delta[1]) + len(delta[2]))
+    def record(self, start, removed, inserted):
+        for group in self.redo_groups:
+            self.used -= sum(self.cost(delta) for delta in group)
+        self.redo_groups.clear()
+        delta = [start, removed, inserted, sum(map(itemgetter(2), removed)), sum(map(itemgetter(2), inserted))]
+        now = time.monotonic()
+        keystroke = delta[3] + delta[4] <= 4
+        group = self.groups[-1] if self.groups and keystroke and self.last_time is not None else None
+        if group is None or now - self.last_time > self.group_gap or len(group) >= self.group_deltas:
+            self.groups.append([delta])
+            self.used += self.cost(delta)
+        else:
+            before = self.cost(group[-1])
+            if self.merge(group[-1], delta):
+                self.used += self.cost(group[-1]) - before
+            else:
+                group.append(delta)
+                self.used += self.cost(delta)
+        self.last_time = now if keystroke else None
+        while self.used > self.budget and self.groups:
+            self.used -= sum(self.cost(d) for d in self.groups.popleft())
+    def merge(self, last, delta):
+        start, removed, inserted, removed_length, inserted_length = delta
+        if not removed_length and not last[3] and start == last[0] + last[4]:
+            last[2] = merge_pieces(last[2] + inserted)
+            last[4] += inserted_length
+        elif not inserted_length and not last[4] and start + removed_length == last[0]:
+            last[0], last[1] = start, merge_pieces(removed + last[1])
+            last[3] += removed_length
+        elif not inserted_length and not last[4] and start == last[0]:
+            last[1] = merge_pieces(last[1] + removed)
+            last[3] += removed_length
+        else:
+            return False
+        return True
+    def undo(self, applied=None):
+        # Takes the newest group back, delta by delta, calling applied(start, pieces out,
+        # pieces in) after each so a view can follow along
+        if not self.groups:
+            return False
+        group = self.groups.pop()
+        self.redo_groups.append(group)
+        self.last_time = None
+        for start, removed, inserted, removed_length, inserted_length in reversed(group):
+            self.doc.splice(start, start + inserted_length, removed)
+            if applied:
+                applied(start, inserted, removed)
+        return True
+    def redo(self, applied=None):
+        if not self.redo_groups:
+            return False
+        group = self.redo_groups.pop()
+        self.groups.append(group)
+        self.last_time = None
+        for start, removed, inserted, removed_length, inserted_length in group:
+            self.doc.splice(start, start + removed_length, inserted)
+            if applied:
+                applied(start, removed, inserted)
+        return True
+
+class TextScan:
+    # Incremental pass over an opened document, a chunk at a time: settles its encoding
+    # (UTF-8 until the first invalid sequence, then Latin-1, which round-trips any bytes)
+    # and counts its lines
+    def __init__(self, doc, chunk=LOAD_CHUNK):
+        self.doc, self.chunk = doc, chunk
+        self.bom = len(codecs.BOM_UTF8) if doc.read(0, 3) == codecs.BOM_UTF8 else 0
+        self.pos = self.bom
+        self.encoding = "utf-8"
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.lines = 0
+        self.last = b"\n"
+    @property
+    def done(self):
+        return self.pos >= len(self.doc)
+    def fraction(self):
+        return self.pos / len(self.doc) if len(self.doc) else 1.0
+    def line_count(self):
+        return self.lines + (self.last != b"\n")
+    def step(self):
+        data = self.doc.read(self.pos, self.pos + self.chunk)
+        self.pos += len(data)
+        self.lines += data.count(b"\n")
+        self.last = data[-1:] or self.last
+        if self.decoder:
+            try:
+                self.decoder.decode(data, final=self.done)
+            except UnicodeDecodeError:
+                self.encoding, self.decoder = "latin-1", None
+    def run(self, budget):
+        # Scan for at most budget seconds; True once the whole document has been seen
+        deadline = time.perf_counter() + budget
+        while not self.done and time.perf_counter() < deadline:
+            self.step()
+        return self.done
+
+@lru_cache(maxsize=32)
+def search_regex(pattern, regex, encoding):
+    # Documents are searched as bytes; compiled once for find-next, the index and replace-all
+    source = pattern.encode(encoding, "replace")
+    return re.compile(source if regex else re.escape(source), re.MULTILINE)
+
+class MatchIndex:
+    # Sorted (start, end) byte offsets of every match of a compiled pattern in a PieceTable.
+    # Built a line-aligned chunk at a time up to pos; an edit shifts the matches after it and
+    # rescans only the lines it touched. Matches are assumed not to span lines.
+    def __init__(self, doc, regex, chunk=LOAD_CHUNK):
+        self.doc, self.regex, self.chunk = doc, regex, chunk
+        self.starts, self.ends = [], []
+        self.pos = 0
+    @property
+    def done(self):
+        return self.pos >= len(self.doc)
+    def scan(self, start, end):
+        base, data, hits = self.doc.search(self.regex, start, end)
+        return [base + m.start() for m in hits], [base + m.end() for m in hits]
+    def step(self):
+        end = self.doc.next_line(min(self.pos + self.chunk, len(self.doc)))
+        starts, ends = self.scan(self.pos, end)
+        self.starts += starts
+        self.ends += ends
+        self.pos = end
+    def run(self, budget):
+        deadline = time.perf_counter() + budget
+        while not self.done and time.perf_counter() < deadline:
+            self.step()
+        return self.done
+    def edited(self, start, old_end, new_end):
+        # The document's [start, old_end) became [start, new_end)
+        if start >= self.pos:
+            # A build that ended on an unterminated last line stopped mid-line; text after
+            # pos can extend a match there, and one that reached the end can hold empty
+            # matches at it, so that line is rescanned from its start
+            low = self.doc.line_start(self.pos)
+            i = bisect.bisect_left(self.starts, low)
+            del self.starts[i:], self.ends[i:]
+            self.pos = low
+            return
+        delta = new_end - old_end
+        low, high = self.doc.line_start(start), self.doc.next_line(new_end)
+        # Matches at high are kept and shifted unless high is the end, whose empty matches
+        # (\Z, $) the rescan finds again
+        i = bisect.bisect_left(self.starts, low)
+        j = bisect.bisect_left(self.starts, high - delta) if high < len(self.doc) else len(self.starts)
+        if high - delta >= self.pos:
+            self.pos = high
+        else:
+            self.pos += delta
+        starts, ends = self.scan(low, high)
+        self.starts[i:] = starts + [s + delta for s in self.starts[j:]]
+        self.ends[i:] = ends + [e + delta for e in self.ends[j:]]
+    def next_after(self, pos):
+        # First match at or after pos (an empty one only past pos), wrapping to the top;
+        # scans ahead of the background build as far as it has to
+        while True:
+            i = bisect.bisect_left(self.starts, pos)
+            if i < len(self.starts) and self.starts[i] == self.ends[i] == pos:
+                i += 1
+            if i < len(self.starts):
+                return self.starts[i], self.ends[i]
+            if self.done:
+                break
+            self.step()
+        return (self.starts[0], self.ends[0]) if self.starts else None
+
+def write_atomic(path, chunks):
+    # Streamed to a file beside the target, fsynced and renamed over it, so an interrupted
+    # save leaves the previous file intact and holds only one chunk in memory at a time
+    commit_part(write_part(path, chunks), path)
+
+def write_part(path, chunks):
+    # The first half of write_atomic: the fsynced file beside path, whose name is returned
+    part = path + ".part"
+    try:
+        with open(part, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return part
+
+def commit_part(part, path):
+    # The second half: the rename over path, made durable
+    try:
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    if os.name != "nt":
+        # Make the rename itself durable
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def common_affixes(old, new):
+    # Lengths of the common prefix and (non-overlapping) common suffix of two byte strings
+    n, step = min(len(old), len(new)), 4096
+    prefix = 0
+    while prefix + step <= n and old[prefix:prefix + step] == new[prefix:prefix + step]:
+        prefix += step
+    while prefix < n and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix, limit, a, b = 0, n - prefix, len(old), len(new)
+    while suffix + step <= limit and old[a - suffix - step:a - suffix] == new[b - suffix - step:b - suffix]:
+        suffix += step
+    while suffix < limit and old[a - suffix - 1] == new[b - suffix - 1]:
+        suffix += 1
+    return prefix, suffix
 
 class Notepad(DraggableWindow):
+    # The document lives in a PieceTable; the Text widget only ever holds a window of about
+    # NOTEPAD_WINDOW_LINES lines around the view, paged in and out as it scrolls
+    window_lines = NOTEPAD_WINDOW_LINES
+    window_bytes = NOTEPAD_WINDOW_BYTES
+    frame_budget = FRAME_MS / 2000  # seconds of scanning per after() step while loading
     def __init__(self, master, **kwargs):
         super().__init__(master, title="Notepad", width=350, height=220, **kwargs)
+        self.doc = PieceTable()
+        self.encoding = "utf-8"
+        self.newline = "\n"
+        self.bom = 0
+        self.win_start = self.win_end = 0
+        self.page_job = None
+        self.scan = None
+        self.scan_job = None
+        self.unchecked = False  # a stopped load left the rest of the file's encoding unchecked
+        self._save_thread = None
+        self.matches = None
+        self.index_job = None
+        self.journal = EditJournal(self.doc)
+        self.reload_at = None
+        self.kept = None  # (widget marks, cursor, selection) left by the last paging
+        # Find row, shown by Ctrl+F
+        self.find_row = tk.Frame(self.frame, bg=WIN_BG)
+        tk.Label(self.find_row, text="Find:", bg=WIN_BG, font=FONT).pack(side=tk.LEFT, padx=(2,0))
+        self.find_entry = tk.Entry(self.find_row, width=9, font=FONT, bg=ENTRY_BG, fg=ENTRY_FG, bd=1, relief=tk.FLAT)
+        self.find_entry.pack(side=tk.LEFT)
+        tk.Label(self.find_row, text="To:", bg=WIN_BG, font=FONT).pack(side=tk.LEFT, padx=(4,0))
+        self.replace_entry = tk.Entry(self.find_row, width=7, font=FONT, bg=ENTRY_BG, fg=ENTRY_FG, bd=1, relief=tk.FLAT)
+        self.replace_entry.pack(side=tk.LEFT)
+        self.regex_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(self.find_row, text="Re", variable=self.regex_var, bg=WIN_BG, font=FONT,
+                       activebackground=WIN_BG, bd=0).pack(side=tk.LEFT)
+        win1_button(self.find_row, text="All", width=3, command=self.replace_all).pack(side=tk.RIGHT, padx=2, pady=2)
+        win1_button(self.find_row, text="Next", width=4, command=self.find_next).pack(side=tk.RIGHT, padx=2, pady=2)
+        self.find_entry.bind("<Return>", lambda e: self.find_next())
+        self.find_entry.bind("<Escape>", lambda e: self.find_row.pack_forget())
+        self.replace_entry.bind("<Escape>", lambda e: self.find_row.pack_forget())
         border = tk.Frame(self.frame, bg=BORDER_DARK, bd=0)
         border.pack(fill=tk.BOTH, expand=True, padx=5, pady=(2,6))
+        self.border = border
+        # The scrollbar spans the whole document, not just the window in the Text widget
+        self.scrollbar = tk.Scrollbar(border, command=self.on_scrollbar, width=12)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.text = tk.Text(
             border,
             font=FONT,
@@ -171,25 +2919,407 @@ class Notepad(DraggableWindow):
             insertbackground=ENTRY_FG,
             wrap=tk.WORD,
             height=10,
-            width=44
+            width=44,
+            yscrollcommand=self.on_text_scroll
         )
         self.text.pack(expand=True, fill=tk.BOTH, padx=2, pady=2)
+        # Tk's own <<Copy>>/<<Cut>> bindings run after these and fill its clipboard
+        self.text.bind("<<Copy>>", self.remember_copy)
+        self.text.bind("<<Cut>>", self.remember_copy)
+        self.text.bind("<Escape>", lambda e: self.cancel_load())
+        self.text.bind("<Control-f>", self.show_find)
+        # Every change goes to the journal as it happens: Tk's own undo stack stays off
+        self.text.bind("<<Modified>>", lambda e: self.sync_window())
+        self.text.bind("<<Undo>>", self.undo)
+        self.text.bind("<<Redo>>", self.redo)
         bottom_bar = tk.Frame(self.frame, bg=WIN_BG, height=18)
         bottom_bar.pack(fill=tk.X, side=tk.BOTTOM)
+        self.status = tk.Label(bottom_bar, text="", bg=WIN_BG, font=FONT)
+        self.status.pack(side=tk.LEFT, padx=(2,0))
         win1_button(bottom_bar, text="Save", width=6, command=self.save_to_file).pack(side=tk.RIGHT, padx=2, pady=2)
         win1_button(bottom_bar, text="OK", width=6, command=self.destroy).pack(side=tk.RIGHT, padx=2, pady=2)
+        win1_button(bottom_bar, text="Open", width=6, command=self.open_file).pack(side=tk.RIGHT, padx=2, pady=2)
+        self.stop_button = win1_button(bottom_bar, text="Stop", width=5, command=self.cancel_load)
+    def remember_copy(self, event):
+        if self.text.tag_ranges(tk.SEL):
+            CLIPBOARD.set_text(self.text.get(tk.SEL_FIRST, tk.SEL_LAST))
+    def decode(self, data):
+        text = data.decode(self.encoding, "replace")
+        return text.replace("\r\n", "\n") if self.newline == "\r\n" else text
+    def encode(self, text):
+        if self.newline == "\r\n":
+            text = text.replace("\n", "\r\n")
+        return text.encode(self.encoding, "replace")
+    def sync_window(self):
+        # Fold edits made in the Text widget back into the document as one minimal replace
+        if not self.text.edit_modified():
+            return
+        new = self.encode(self.text.get("1.0", "end-1c"))
+        old = self.doc.read(self.win_start, self.win_end)
+        prefix, suffix = common_affixes(old, new)
+        if self.encoding == "utf-8":
+            # Whole characters only, so undo can map the change back onto the widget
+            while prefix and any(prefix < len(b) and b[prefix] & 0xC0 == 0x80 for b in (old, new)):
+                prefix -= 1
+            while suffix and old[len(old) - suffix] & 0xC0 == 0x80:
+                suffix -= 1
+        self.win_end = self.win_start + len(new)
+        self.text.edit_modified(False)
+        if prefix + suffix == len(old) == len(new):
+            return
+        start, end = self.win_start + prefix, self.win_start + len(old) - suffix
+        removed, inserted = self.doc.replace(start, end, new[prefix:len(new) - suffix])
+        self.journal.record(start, removed, inserted)
+        if self.matches:
+            self.matches.edited(start, end, start + len(new) - prefix - suffix)
+    def char_boundary(self, offset):
+        # A window cut inside an overlong line must not split a multi-byte character
+        if self.encoding == "utf-8":
+            while 0 < offset < len(self.doc) and self.doc.read(offset, offset + 1)[0] & 0xC0 == 0x80:
+                offset += 1
+        return offset
+    def load_window(self, offset, cursor=None, selection=None):
+        # Page in the lines around offset. The insert position and selection stay where they
+        # were in the document, unless cursor gives a new insert position.
+        self.sync_window()
+        if cursor is None:
+            cursor, selection = self.marks()
+        doc, half = self.doc, self.window_bytes // 2
+        # Lines are counted from the start of offset's line, but inside a line longer than
+        # the window the bytes on either side of offset itself are, so it ends up mid-window
+        offset = max(self.char_boundary(min(offset, len(doc))), self.bom)
+        start = end = max(self.char_boundary(doc.line_start(offset, half // 2)), self.bom)
+        for _ in range(self.window_lines // 2):
+            if start == 0 or offset - start >= half:
+                break
+            start = doc.line_start(start - 1, half - (offset - start))
+        for _ in range(self.window_lines // 2):
+            if end >= len(doc) or end - offset >= half:
+                break
+            end = doc.next_line(end, half - (end - offset))
+        start, end = max(self.char_boundary(start), self.bom), self.char_boundary(end)
+        if self.page_job:
+            self.after_cancel(self.page_job)
+            self.page_job = None
+        data = doc.read(start, end)
+        if self.unchecked:
+            # Bytes that aren't UTF-8 would come back from the widget as U+FFFD, so the first
+            # window holding any falls back to Latin-1 as the scan would have
+            try:
+                data.decode("utf-8")
+            except UnicodeDecodeError:
+                self.encoding, self.unchecked = "latin-1", False
+                self.status.config(text=f"{ENCODING_NAMES[self.encoding]}{' BOM' if self.bom else ''}, not UTF-8 past where the load stopped")
+        self.win_start, self.win_end = start, end
+        # Paging also happens while a load keeps the widget read-only
+        state = self.text.cget("state")
+        self.text.config(state=tk.NORMAL)
+        self.text.delete("1.0", tk.END)
+        self.text.insert("1.0", self.decode(data))
+        self.text.config(state=state)
+        self.text.edit_modified(False)
+        self.text.edit_reset()
+        # A character index, as offset may sit partway along a wrapped line
+        self.text.yview(f"1.0 + {len(self.decode(doc.read(start, offset)))} chars")
+        self.place_marks(cursor, selection)
+    def widget_marks(self):
+        return self.text.index(tk.INSERT), tuple(map(str, self.text.tag_ranges(tk.SEL)))
+    def marks(self):
+        # Insert position and selection (or None) as document offsets
+        state = self.widget_marks()
+        if self.kept and self.kept[0] == state:
+            return self.kept[1:]
+        insert, selection = state
+        offset = lambda index: self.win_start + len(self.encode(self.text.get("1.0", index)))
+        return offset(insert), selection and (offset(selection[0]), offset(selection[1]))
+    def place_marks(self, cursor, selection):
+        # What lies outside the window is shown on its nearest edge, and remembered for as
+        # long as the widget's insert position and selection are left where they were put
+        def index(offset):
+            offset = self.char_boundary(min(max(offset, self.win_start), self.win_end))
+            return f"1.0 + {len(self.decode(self.doc.read(self.win_start, offset)))} chars"
+        self.text.mark_set(tk.INSERT, index(cursor))
+        self.text.tag_remove(tk.SEL, "1.0", tk.END)
+        if selection:
+            self.text.tag_add(tk.SEL, index(selection[0]), index(selection[1]))
+        self.kept = (self.widget_marks(), cursor, selection)
+    def top_offset(self):
+        # Document offset of the first visible character, which in a long wrapped line is
+        # well past the start of its line
+        prefix = self.text.get("1.0", self.text.index("@0,0"))
+        return self.win_start + len(self.encode(prefix))
+    def repage(self):
+        self.page_job = None
+        top = self.top_offset()
+        self.load_window(top)
+    def on_text_scroll(self, first, last):
+        first, last = float(first), float(last)
+        span, size = self.win_end - self.win_start, max(len(self.doc), 1)
+        self.scrollbar.set((self.win_start + first * span) / size, (self.win_start + last * span) / size)
+        # Page when the view nears an edge of the window that is not the document's edge
+        if (first < 0.2 and self.win_start > 0) or (last > 0.8 and self.win_end < len(self.doc)):
+            if not self.page_job:
+                self.page_job = self.after_idle(self.repage)
+    def on_scrollbar(self, *args):
+        if args[0] == "moveto":
+            self.load_window(int(float(args[1]) * len(self.doc)))
+        else:
+            self.text.yview(*args)
+    def open_file(self):
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Text Files","*.txt"), ("All Files", "*.*")]
+        )
+        if not file_path or self._save_thread:
+            return
+        try:
+            doc = PieceTable.open(file_path)
+        except Exception as e:
+            messagebox.showerror("Notepad", f"Error opening file:\n{e}")
+            return
+        self.cancel_load()
+        self.drop_matches()
+        self.doc.close()
+        self.doc = doc
+        self.journal = EditJournal(doc)
+        self.newline = "\r\n" if b"\r\n" in doc.read(0, 65536) else "\n"
+        self.win_start = self.win_end = 0
+        self.text.edit_modified(False)
+        self.title_label.config(text=f"Notepad - {os.path.basename(file_path)}")
+        # The first chunk decides how the first screen is decoded; the rest is scanned in
+        # after() steps, read-only, so a later switch of encoding can't garble any edits
+        self.scan = TextScan(doc)
+        self.scan.step()
+        self.bom, self.encoding = self.scan.bom, self.scan.encoding
+        self.load_window(0, 0)
+        if self.scan.done:
+            self.finish_load()
+        else:
+            self.text.config(state=tk.DISABLED)
+            self.stop_button.pack(side=tk.RIGHT, padx=2, pady=2)
+            self.scan_job = self.after(1, self.load_step)
+    def load_step(self):
+        self.scan_job = None
+        done = self.scan.run(self.frame_budget)
+        if self.scan.encoding != self.encoding:
+            top, (cursor, selection) = self.top_offset(), self.marks()
+            self.encoding = self.scan.encoding
+            self.load_window(top, cursor, selection)
+        if done:
+            self.finish_load()
+        else:
+            self.status.config(text=f"Reading {self.scan.fraction():.0%}")
+            self.scan_job = self.after(1, self.load_step)
+    def finish_load(self, stopped=False):
+        if self.scan_job:
+            self.after_cancel(self.scan_job)
+            self.scan_job = None
+        name = ENCODING_NAMES[self.encoding] + (" BOM" if self.bom else "")
+        if stopped:
+            self.status.config(text=f"{name}, stopped at {self.scan.fraction():.0%}")
+        else:
+            self.status.config(text=f"{name}, {self.scan.line_count():,} lines")
+        self.scan = None
+        self.stop_button.pack_forget()
+        self.text.config(state=tk.NORMAL)
+        self.unchecked = stopped and self.encoding == "utf-8"
+        if self.unchecked:
+            self.load_window(self.top_offset())
+    def cancel_load(self):
+        # Stopping only ends the scan: the document is the whole mapped file either way, and
+        # the encoding stays the one settled on so far
+        if self.scan:
+            self.finish_load(stopped=True)
+    def show_find(self, event=None):
+        if not self.find_row.winfo_ismapped():
+            self.find_row.pack(fill=tk.X, before=self.border)
+        self.find_entry.focus_set()
+        self.find_entry.select_range(0, tk.END)
+        return "break"
+    def search_regex(self):
+        pattern = self.find_entry.get()
+        if not pattern:
+            return None
+        try:
+            return search_regex(pattern, self.regex_var.get(), self.encoding)
+        except re.error as e:
+            self.status.config(text=f"Bad pattern: {e}")
+            return None
+    def drop_matches(self):
+        if self.index_job:
+            self.after_cancel(self.index_job)
+            self.index_job = None
+        self.matches = None
+    def match_index(self, regex):
+        # One index per pattern, finished in after() steps; find-next scans ahead if it must
+        if not self.matches or self.matches.regex is not regex:
+            self.drop_matches()
+            self.matches = MatchIndex(self.doc, regex)
+            self.index_job = self.after(1, self.index_step)
+        return self.matches
+    def index_step(self):
+        self.index_job = None
+        if self.matches.run(self.frame_budget):
+            self.status.config(text=f"{len(self.matches.starts):,} matches")
+        else:
+            self.index_job = self.after(1, self.index_step)
+    def cursor_offset(self):
+        return self.marks()[0]
+    def find_next(self):
+        regex = self.search_regex()
+        if not regex:
+            return
+        self.sync_window()
+        hit = self.match_index(regex).next_after(self.cursor_offset())
+        if not hit:
+            self.status.config(text="Not found")
+            self.bell()
+            return
+        start, end = hit
+        if not self.win_start <= start <= end <= self.win_end:
+            self.load_window(start)
+        first = f"1.0 + {len(self.decode(self.doc.read(self.win_start, start)))} chars"
+        last = f"{first} + {len(self.decode(self.doc.read(start, end)))} chars"
+        self.text.tag_remove(tk.SEL, "1.0", tk.END)
+        self.text.tag_add(tk.SEL, first, last)
+        self.text.mark_set(tk.INSERT, last)
+        self.text.see(first)
+    def replace_all(self):
+        # One pass over the document and one reload of the widget, however many hits
+        regex = self.search_regex()
+        if not regex or self.scan:
+            return
+        repl = self.replace_entry.get().encode(self.encoding, "replace")
+        if not self.regex_var.get():
+            repl = repl.replace(b"\\", b"\\\\")
+        self.sync_window()
+        top = self.top_offset()
+        before = self.doc.pieces
+        try:
+            count = self.doc.sub(regex, repl)
+        except re.error as e:
+            self.status.config(text=f"Bad replacement: {e}")
+            return
+        if count:
+            self.journal.record(0, before, self.doc.pieces)
+        self.drop_matches()
+        top = min(top, len(self.doc))
+        self.load_window(top, top)
+        self.status.config(text=f"Replaced {count:,}")
+    def undo(self, event=None):
+        self.history_step(self.journal.undo)
+        return "break"
+    def redo(self, event=None):
+        self.history_step(self.journal.redo)
+        return "break"
+    def history_step(self, step):
+        if self.scan:
+            return
+        self.sync_window()
+        self.reload_at = None
+        if not step(self.show_change):
+            self.bell()
+            return
+        self.text.edit_modified(False)
+        if self.reload_at is not None:
+            self.load_window(self.reload_at, self.reload_at)
+        else:
+            self.text.see(tk.INSERT)
+    def show_change(self, start, taken, put):
+        # Patch the widget in place for a change inside the window; otherwise (or with CRLF
+        # line ends, where bytes and widget characters don't line up) reload it afterwards
+        old, new = self.doc.join(taken), self.doc.join(put)
+        if self.matches:
+            self.matches.edited(start, start + len(old), start + len(new))
+        if (self.reload_at is not None or self.newline != "\n"
+                or not self.win_start <= start <= start + len(old) <= self.win_end):
+            self.reload_at = start
+            return
+        first = f"1.0 + {len(self.decode(self.doc.read(self.win_start, start)))} chars"
+        self.text.delete(first, f"{first} + {len(self.decode(old))} chars")
+        self.text.insert(first, self.decode(new))
+        self.text.mark_set(tk.INSERT, f"{first} + {len(self.decode(new))} chars")
+        self.win_end += len(new) - len(old)
     def save_to_file(self):
+        if self.scan or self._save_thread:
+            return
         file_path = filedialog.asksaveasfilename(
             defaultextension=".txt",
             filetypes=[("Text Files","*.txt"), ("All Files", "*.*")]
         )
-        if file_path:
+        if not file_path:
+            return
+        # Snapshot on the UI thread, stream it out on a worker thread
+        self.sync_window()
+        self.start_save(file_path, self.doc.snapshot())
+    def start_save(self, path, doc):
+        def chunks():
+            for chunk in doc.chunks():
+                yield chunk
+                self._save_written += len(chunk)
+        def run():
+            # The rename is left to the Tk thread, which may have to release the document first
+            try:
+                self._save_part = write_part(path, chunks())
+                self._save_result = (True, "File saved successfully!")
+            except Exception as e:
+                self._save_result = (False, f"Error saving file:\n{e}")
+        self._save_path = path
+        self._save_written, self._save_size = 0, len(doc)
+        self._save_status = self.status.cget("text")
+        self._save_thread = threading.Thread(target=run, daemon=True)
+        self._save_thread.start()
+        self.after(50, self.poll_save)
+    def poll_save(self):
+        # Runs on the Tk thread via after, so it may touch widgets; the worker never does
+        if not self.winfo_exists():
+            return
+        if self._save_thread.is_alive():
+            self.status.config(text=f"Saving {self._save_written / max(self._save_size, 1):.0%}")
+            self.after(50, self.poll_save)
+            return
+        self.status.config(text=self._save_status)
+        ok, message = self.finish_save()
+        if ok:
+            messagebox.showinfo("Notepad", message)
+        else:
+            messagebox.showerror("Notepad", message)
+    def finish_save(self):
+        self._save_thread = None
+        ok, message = self._save_result
+        if ok:
             try:
-                with open(file_path, "w", encoding="utf-8") as f:
-                    f.write(self.text.get("1.0", tk.END))
-                messagebox.showinfo("Notepad", "File saved successfully!")
+                self.commit_save(self._save_part, self._save_path)
             except Exception as e:
-                messagebox.showerror("Notepad", f"Error saving file:\n{e}")
+                ok, message = False, f"Error saving file:\n{e}"
+        return ok, message
+    def commit_save(self, part, path):
+        # Windows can't replace a file that is mapped, so saving over the document's own file
+        # lets the mapping go first and re-bases the document on the saved copy, which holds
+        # exactly its text. Undo history is re-pointed to match, keeping what the file lost.
+        doc = self.doc
+        if not (doc.path and os.path.exists(doc.path) and os.path.exists(path) and os.path.samefile(doc.path, path)):
+            commit_part(part, path)
+            return
+        deltas = [delta for group in chain(self.journal.groups, self.journal.redo_groups) for delta in group]
+        lists = doc.repoint([delta[k] for delta in deltas for k in (1, 2)])
+        doc.close()
+        try:
+            commit_part(part, path)
+        except BaseException:
+            doc.original = map_file(doc.path)  # the old file is still there
+            raise
+        doc.rebase(map_file(path), path)
+        for i, delta in enumerate(deltas):
+            delta[1], delta[2] = lists[2 * i], lists[2 * i + 1]
+    def destroy(self):
+        self.cancel_load()
+        self.drop_matches()
+        # A save in flight still reads the mapped file: let it finish before unmapping
+        if self._save_thread:
+            self._save_thread.join()
+            self.finish_save()
+        self.doc.close()
+        super().destroy()
 
 class Calculator(DraggableWindow):
     def __init__(self, master, **kwargs):
@@ -209,6 +3339,8 @@ class Calculator(DraggableWindow):
             width=18
         )
         self.display.pack(fill=tk.X, ipady=2)
+        self.display.bind("<<Copy>>", self.remember_copy)
+        self.display.bind("<<Cut>>", self.remember_copy)
         btns = [
             ["7", "8", "9", "/"],
             ["4", "5", "6", "*"],
@@ -228,6 +3360,9 @@ class Calculator(DraggableWindow):
         fr2.pack()
         win1_button(fr2, text="CE", width=6, command=self.clear_all).pack(side=tk.LEFT, padx=2, pady=2)
         win1_button(fr2, text="C", width=6, command=self.clear).pack(side=tk.LEFT, padx=2, pady=2)
+    def remember_copy(self, event):
+        if self.display.selection_present():
+            CLIPBOARD.set_text(self.display.selection_get())
     def add_char(self, ch):
         self.expr += ch
         self.display.delete(0, tk.END)
@@ -277,6 +3412,317 @@ class MainApp(tk.Tk):
     def launch_paint(self):
         PaintApp(self)
 
+# --- Paint benchmark: scripted mouse input replayed into a real PaintApp
+BENCH_WORKLOADS = ("scribble", "long-stroke", "strokes", "clear", "pan")
+PAN_DOCUMENT = (8192, 8192)  # the pan workload's document size unless one is given
+
+def bench_events(workload):
+    # Canned input as [kind, x, y] entries; kinds are press, motion, release and clear
+    # (the Clear button), and for the view pan-press, pan, pan-release (middle drag) and
+    # wheel-in, wheel-out. Coordinates stay inside the default viewport.
+    events = []
+    if workload in ("scribble", "long-stroke"):
+        # One long stroke; the 50,000-sample one is the redraw case for strokes as polylines
+        events.append(["press", 170, 85])
+        for i in range(20000 if workload == "scribble" else 50000):
+            t = i / 40
+            events.append(["motion", int(170 + 150 * math.sin(t * 1.3)), int(85 + 70 * math.sin(t * 1.7 + 1))])
+        events.append(["release"] + events[-1][1:])
+    elif workload == "strokes":
+        # Many short strokes
+        for n in range(1000):
+            x, y = 20 + n * 37 % 290, 20 + n * 53 % 120
+            events.append(["press", x, y])
+            for i in range(1, 11):
+                events.append(["motion", x + 3 * i, y + i * i % 7])
+            events.append(["release", x + 30, y + 2])
+    elif workload == "clear":
+        # Medium strokes with the canvas cleared every few of them
+        for n in range(300):
+            x, y = 20 + n * 41 % 290, 20 + n * 29 % 120
+            events.append(["press", x, y])
+            for i in range(1, 31):
+                events.append(["motion", x + int(20 * math.sin(i / 4)), y + i % 40])
+            events.append(["release"] + events[-1][1:])
+            if n % 5 == 4:
+                events.append(["clear", 0, 0])
+    elif workload == "pan":
+        # Middle-drag sweeps across a large document at 1:1, zoomed out to 1/8 and back in
+        # to 2x with the wheel, each level panning out and back so the LOD cache sees both
+        # new and already reduced tiles
+        for wheel in (None, "wheel-out", "wheel-out", "wheel-out", "wheel-in", "wheel-in", "wheel-in", "wheel-in"):
+            if wheel:
+                events.append([wheel, 170, 85])
+            for sweep in range(6):
+                start, end = ((320, 160), (20, 10)) if sweep < 3 else ((20, 10), (320, 160))
+                events.append(["pan-press", *start])
+                for i in range(1, 61):
+                    events.append(["pan", start[0] + (end[0] - start[0]) * i // 60, start[1] + (end[1] - start[1]) * i // 60])
+                events.append(["pan-release", *end])
+    else:
+        raise ValueError(f"unknown workload {workload!r}")
+    return events
+
+def bench_engines():
+    return [engine for engine in sorted(SURFACES) if engine != "numpy" or np is not None]
+
+def latency_summary(latencies):
+    # Percentiles and maximum in milliseconds
+    latencies = sorted(latencies)
+    n = len(latencies)
+    if not n:
+        return {}
+    latency = {f"p{q}": round(latencies[min(n - 1, n * q // 100)] * 1000, 3) for q in (50, 90, 99)}
+    latency["max"] = round(latencies[-1] * 1000, 3)
+    return latency
+
+def bench_lines(args):
+    # Hard-pen segment throughput of each paint engine, no display needed. Segments come
+    # from the scribble workload's path; a batch is one lines() call, as a frame's flush
+    # (16) or replaying a whole stroke (all of them) hands the surface.
+    path = [event[1:] for event in bench_events("scribble")]
+    segments = [tuple(a) + tuple(b) for a, b in zip(path, path[1:])]
+    size = [args.width or 340, args.height or 170]
+    results = []
+    for engine in bench_engines():
+        for width in (1, 2, 8, 16):
+            for batch in (16, len(segments)):
+                surface = SURFACES[engine](*size)
+                start = time.perf_counter()
+                for i in range(0, len(segments), batch):
+                    surface.lines(segments[i:i + batch], "#000000", width)
+                elapsed = time.perf_counter() - start
+                results.append({"workload": "lines", "engine": engine, "width": width, "batch": batch,
+                                "size": size, "segments": len(segments),
+                                "seconds": round(elapsed, 4), "segments_per_second": round(len(segments) / elapsed, 1)})
+                print(f"lines: {engine} width {width} batch {batch}: {results[-1]['segments_per_second']} segments/s",
+                      file=sys.stderr)
+    return results
+
+def bench_undo(args):
+    # Undo and redo latency after 10,000 short strokes: each step replays at most a
+    # checkpoint interval of ops, so it should not grow with the length of the history
+    size = [args.width or 340, args.height or 170]
+    results = []
+    for engine in bench_engines():
+        core = PaintCore(*size, engine)
+        start = time.perf_counter()
+        for n in range(10000):
+            x, y = n * 37 % size[0], n * 53 % size[1]
+            core.set_color(("#000000", "#ff0000", "#0000ff")[n % 3])
+            core.begin_stroke(x, y)
+            for i in range(1, 11):
+                core.extend_stroke(x + 3 * i, y + i * i % 7)
+            core.end_stroke()
+        drawn = time.perf_counter() - start
+        latencies = {"undo": [], "redo": []}
+        for step in ("undo", "redo"):
+            for _ in range(200):
+                t0 = time.perf_counter()
+                getattr(core, step)()
+                latencies[step].append(time.perf_counter() - t0)
+        results.append({"workload": "undo", "engine": engine, "size": size, "strokes": 10000,
+                        "draw_seconds": round(drawn, 4), "undo_ms": latency_summary(latencies["undo"]),
+                        "redo_ms": latency_summary(latencies["redo"]), "checkpoints": len(core.checkpoints),
+                        "checkpoint_bytes": sum(cp.size for cp in core.checkpoints)})
+        print(f"undo: {engine} after 10000 strokes: p50 {results[-1]['undo_ms']['p50']} ms, "
+              f"max {results[-1]['undo_ms']['max']} ms", file=sys.stderr)
+    return results
+
+def bench_fill(args):
+    # Bucket fill of a blank 4-megapixel page, and of one ruled with gapped lines so the
+    # fill snakes through the page as thousands of short spans
+    size = [args.width or 2048, args.height or 2048]
+    results = []
+    for engine in bench_engines():
+        for page in ("blank", "ruled"):
+            core = PaintCore(*size, engine, checkpoint_interval=0)
+            if page == "ruled":
+                for y in range(8, size[1], 16):
+                    gap = 0 if y // 16 % 2 else 40
+                    core.draw_stroke({"color": "#000000", "width": 2, "points": [gap, y, size[0] - 40 + gap, y]})
+                core.end_stroke()
+            start = time.perf_counter()
+            core.fill(1, 1, "#ff0000")
+            elapsed = time.perf_counter() - start
+            results.append({"workload": "fill", "engine": engine, "page": page, "size": size,
+                            "ms": round(elapsed * 1000, 2)})
+            print(f"fill: {engine} {page} {size[0]}x{size[1]}: {results[-1]['ms']} ms", file=sys.stderr)
+    return results
+
+HEADLESS_BENCHMARKS = {"lines": bench_lines, "undo": bench_undo, "fill": bench_fill}
+
+def replay_events(app, events):
+    # Feed events to the canvas with event_generate and pump Tk after each one, as the
+    # event loop would, so a latency includes any frame or idle work the event triggered
+    canvas = app.canvas
+    sequences = {"press": "<ButtonPress-1>", "motion": "<B1-Motion>", "release": "<ButtonRelease-1>",
+                 "pan-press": "<ButtonPress-2>", "pan": "<B2-Motion>", "pan-release": "<ButtonRelease-2>"}
+    latencies = []
+    peak_items = 0
+    start = time.perf_counter()
+    for i, (kind, x, y) in enumerate(events):
+        t0 = time.perf_counter()
+        if kind == "clear":
+            app.clear_canvas()
+        elif kind in ("wheel-in", "wheel-out"):
+            canvas.event_generate("<MouseWheel>", x=x, y=y, delta=120 if kind == "wheel-in" else -120)
+        else:
+            canvas.event_generate(sequences[kind], x=x, y=y)
+        app.update()
+        latencies.append(time.perf_counter() - t0)
+        if kind not in ("motion", "pan") or i % 256 == 0:
+            peak_items = max(peak_items, len(canvas.find_all()))
+    app.update()
+    elapsed = time.perf_counter() - start
+    # A full repaint of what is left on the canvas, as after the window is uncovered: the
+    # cost that grows with the number of canvas items
+    t0 = time.perf_counter()
+    canvas.configure(background=canvas.cget("background"))
+    canvas.update_idletasks()
+    redraw = time.perf_counter() - t0
+    n = len(latencies)
+    return {
+        "events": n,
+        "seconds": round(elapsed, 4),
+        "events_per_second": round(n / elapsed, 1) if elapsed else None,
+        "latency_ms": latency_summary(latencies),
+        "redraw_ms": round(redraw * 1000, 3),
+        "canvas_items": {"peak": peak_items, "final": len(canvas.find_all())},
+        "frame_stats": dict(app.frame_stats),
+    }
+
+def bench_draw(root, args):
+    # Events per second through PaintApp.draw alone, called directly with the scribble
+    # workload's motion events: as it is, and with the width_var read it used to make before
+    # every motion, for a before/after comparison of the traced brush
+    size = [args.width or 340, args.height or 170]
+    motions = []
+    for kind, x, y in bench_events("scribble"):
+        if kind == "motion":
+            event = tk.Event()
+            event.x, event.y = x, y
+            motions.append(event)
+    results = []
+    for mode in ("per-event read", "traced"):
+        app = PaintApp(root, *size, args.engine)
+        app.journal_dir = None
+        app.brush_var.set(args.brush)
+        app.update()
+        app.start_draw(motions[0])
+        if mode == "traced":
+            handler = app.draw
+        else:
+            def handler(event):
+                try:
+                    app.core.set_width(int(app.width_var.get()))
+                except Exception:
+                    app.core.set_width(2)
+                app.draw(event)
+        start = time.perf_counter()
+        for event in motions:
+            handler(event)
+        elapsed = time.perf_counter() - start
+        app.reset_draw(motions[-1])
+        app.destroy()
+        results.append({"workload": "draw", "engine": args.engine, "brush": args.brush, "mode": mode, "size": size,
+                        "events": len(motions), "seconds": round(elapsed, 4),
+                        "events_per_second": round(len(motions) / elapsed, 1)})
+        print(f"draw: {mode}: {results[-1]['events_per_second']} events/s", file=sys.stderr)
+    return results
+
+def start_xvfb():
+    # Private virtual X server; -displayfd makes it pick a free display and report it
+    read_fd, write_fd = os.pipe()
+    server = subprocess.Popen(["Xvfb", "-displayfd", str(write_fd), "-screen", "0", "1024x768x24", "-nolisten", "tcp"],
+                              pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        display = f.readline().strip()
+    if not display:
+        server.kill()
+        raise RuntimeError("Xvfb did not start")
+    os.environ["DISPLAY"] = ":" + display
+    return server
+
+def paint_benchmark(argv):
+    parser = argparse.ArgumentParser(
+        prog=f"{os.path.basename(sys.argv[0])} bench",
+        description="Replay scripted mouse input into Paint and report throughput, latency and canvas items as JSON."
+    )
+    parser.add_argument("workloads", nargs="*", default=list(BENCH_WORKLOADS),
+                        help=f"canned workloads ({', '.join(BENCH_WORKLOADS)}), headless ones "
+                             f"({', '.join(HEADLESS_BENCHMARKS)}), draw (the motion handler alone, "
+                             f"before and after the traced brush) or JSON files of [kind, x, y] events")
+    parser.add_argument("-o", "--output", help="write the JSON results here (default: stdout)")
+    parser.add_argument("--engine", choices=sorted(SURFACES), default="pil")
+    parser.add_argument("--brush", choices=BRUSHES, default="hard")
+    parser.add_argument("--smoothing", choices=["catmull-rom"])
+    parser.add_argument("--width", type=int, help="document width (default: 340, or 8192 for pan)")
+    parser.add_argument("--height", type=int, help="document height (default: 170, or 8192 for pan)")
+    parser.add_argument("--xvfb", action="store_true", help="run under a private Xvfb (default when there is no DISPLAY)")
+    args = parser.parse_args(argv)
+    replayed = [workload for workload in args.workloads if workload not in HEADLESS_BENCHMARKS]
+    if Image is None and len(replayed) < len(args.workloads):
+        parser.error("Pillow is required for the headless benchmarks.\nInstall with: pip install pillow")
+    server = None
+    if replayed and (args.xvfb or (sys.platform.startswith("linux") and not os.environ.get("DISPLAY"))):
+        try:
+            server = start_xvfb()
+        except (OSError, RuntimeError) as e:
+            parser.error(f"no display and Xvfb could not be started: {e}")
+    results = []
+    for workload in args.workloads:
+        if workload in HEADLESS_BENCHMARKS:
+            results.extend(HEADLESS_BENCHMARKS[workload](args))
+    try:
+        root = None
+        if replayed:
+            root = tk.Tk()
+            root.withdraw()
+        for workload in replayed:
+            if workload == "draw":
+                results.extend(bench_draw(root, args))
+                continue
+            if workload in BENCH_WORKLOADS:
+                events = bench_events(workload)
+            else:
+                with open(workload, encoding="utf-8") as f:
+                    events = json.load(f)
+            default = PAN_DOCUMENT if workload == "pan" else (340, 170)
+            size = [args.width or default[0], args.height or default[1]]
+            app = PaintApp(root, *size, args.engine)
+            app.journal_dir = None  # no recovery prompt to block on, no journal writes in the timings
+            app.smoothing = args.smoothing
+            app.brush_var.set(args.brush)
+            app.update()
+            result = {"workload": workload, "engine": args.engine, "brush": args.brush, "smoothing": args.smoothing,
+                      "size": size}
+            result.update(replay_events(app, events))
+            results.append(result)
+            app.destroy()
+            latency = result["latency_ms"]
+            print(f"{workload}: {result['events_per_second']} events/s, p50 {latency.get('p50')} ms, "
+                  f"p99 {latency.get('p99')} ms, peak {result['canvas_items']['peak']} items, "
+                  f"redraw {result['redraw_ms']} ms", file=sys.stderr)
+        if root:
+            root.destroy()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    output = json.dumps({"python": sys.version.split()[0], "tk": tk.TkVersion, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["render"]:
+        sys.exit(batch_render(sys.argv[2:]))
+    if sys.argv[1:2] == ["bench"]:
+        sys.exit(paint_benchmark(sys.argv[2:]))
     app = MainApp()
     app.mainloop()
\ No newline at end of file